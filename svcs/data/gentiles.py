@@ -15,68 +15,296 @@ import time
 from datetime import datetime
 
 import json
-from collections import namedtuple
+import hashlib
+from collections import namedtuple, OrderedDict, deque
+import asyncio
 import argparse
 import logging
+import logging.handlers
+import atexit
+import random
+import signal
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import gzip
+import sys
+import re
+import multiprocessing
+from queue import Empty, SimpleQueue
+import sqlite3
+import threading
+import struct
+from array import array
+from bisect import bisect_left
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import aiopg
 import psycopg2
 from psycopg2.extras import NamedTupleCursor
 
+import aiohttp
 from aiohttp import web
 
+# N.B. cumulative metrics keep counting across worker restarts, see metrics_aggregate
 class StatCounter(object):
-    def __init__(self, name, help):
+    cumulative = True
+
+    def __init__(self, name, help, labels=''):
         self.name = name
         self.help = help
+        self.labels = labels
         self.value = 0
 
     def inc(self):
         self.value += 1
 
+    def snapshot(self):
+        return self.value
+
+    def fresh(self):
+        return StatCounter(self.name, self.help, self.labels)
+
+    def merge(self, snapshot):
+        self.value += snapshot
+
+    def report_samples(self):
+        if self.labels:
+            return '{0}{{{1}}} {2}\n'.format(self.name, self.labels, self.value)
+        return '{0} {1}\n'.format(self.name, self.value)
+
     def report(self):
-        f = '# HELP {name} {help}\n# TYPE {name} counter\n{name} {value}\n'
-        s = f.format(name=self.name, help = self.help, value = self.value)
+        f = '# HELP {name} {help}\n# TYPE {name} counter\n'
+        s = f.format(name=self.name, help = self.help) + self.report_samples()
         return s
 
+# workers' gauges are summed, except per worker copies of shared state such
+# as the empty tile index, which aggregate='max' reports once
+class StatGauge(object):
+    cumulative = False
+
+    def __init__(self, name, help, labels='', aggregate='sum'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.aggregate = aggregate
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+    def fresh(self):
+        return StatGauge(self.name, self.help, self.labels, self.aggregate)
+
+    def merge(self, snapshot):
+        if self.aggregate == 'max':
+            self.value = max(self.value, snapshot)
+        else:
+            self.value += snapshot
+
+    def report_samples(self):
+        if self.labels:
+            return '{0}{{{1}}} {2}\n'.format(self.name, self.labels, self.value)
+        return '{0} {1}\n'.format(self.name, self.value)
+
+    def report(self):
+        f = '# HELP {name} {help}\n# TYPE {name} gauge\n'
+        s = f.format(name=self.name, help = self.help) + self.report_samples()
+        return s
+
+# upper bounds growing by factor from start, for latencies spanning decades
+def exponential_buckets(start, factor, count):
+    return [start * factor ** i for i in range(count)]
+
 class StatHistogram(object):
-    def __init__(self, name, help, interval, bucket_count):
+    cumulative = True
+
+    def __init__(self, name, help, interval, bucket_count, labels='', bounds=None):
         self.name = name
         self.help = help
+        self.labels = labels
+        if bounds == None:
+            bounds = [(i+1)*interval for i in range(0, bucket_count)]
+        self.set_bounds(bounds)
+
+    def set_bounds(self, bounds):
+        self.bounds = list(bounds)
+        self.buckets = [0] * len(self.bounds)
         self.sum = 0
-        self.interval = interval
-        self.buckets = [0] * bucket_count
         self.count = 0
-        self.bucket_count = bucket_count
-        self.max_value = bucket_count * interval
+
+    def snapshot(self):
+        return {'buckets': self.buckets, 'sum': self.sum, 'count': self.count}
+
+    def fresh(self):
+        return StatHistogram(self.name, self.help, None, None, self.labels, self.bounds)
+
+    def merge(self, snapshot):
+        self.buckets = [a + b for (a, b) in zip(self.buckets, snapshot['buckets'])]
+        self.sum += snapshot['sum']
+        self.count += snapshot['count']
 
     def sample(self, value):
         self.count += 1
         self.sum += value
-        if value <= self.max_value:
-            index = math.trunc(value / self.interval)
-            if index * self.interval == value:
-                index -= 1
+        # first bucket whose upper bound is >= value, past the last only +Inf counts it
+        index = bisect_left(self.bounds, value)
+        if index < len(self.buckets):
             self.buckets[index] += 1
 
+    def report_samples(self):
+        if self.labels:
+            bucket_f = '{0}_bucket{{' + self.labels + ',le="{1}"}} {2}\n'
+            label_f = '{' + self.labels + '}'
+        else:
+            bucket_f = '{0}_bucket{{le="{1}"}} {2}\n'
+            label_f = ''
+        # prometheus buckets are cumulative
+        cumulative = 0
+        buckets = []
+        for (bound, n) in zip(self.bounds, self.buckets):
+            cumulative += n
+            buckets.append(bucket_f.format(self.name, bound, cumulative))
+        total = bucket_f.format(self.name, '+Inf', self.count)
+        sum = '{0}_sum{1} {2}\n'.format(self.name, label_f, self.sum)
+        count = '{0}_count{1} {2}\n'.format(self.name, label_f, self.count)
+        return ''.join(buckets + [total, sum, count])
+
     def report(self):
         header = '# HELP {0} {1}\n# TYPE {0} histogram\n'.format(self.name, self.help)
-        bucket_f = '{0}_bucket{{le="{1}"}} {2}\n'
-        buckets = ''.join([bucket_f.format(self.name, (i+1)*self.interval, self.buckets[i]) for i in range(0, self.bucket_count)])
-        total = bucket_f.format(self.name, '+Inf', self.count)
-        sum = '{0}_sum {1}\n'.format(self.name, self.sum)
-        count = '{0}_count {1}\n'.format(self.name, self.count)
-        return ''.join([header, buckets, total, sum, count])
+        return header + self.report_samples()
+
+# one metric per combination of label values, label is a name or a list of names
+class StatFamily(object):
+    kind = None
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        if isinstance(label, str):
+            label = [label]
+        self.label = label
+        self.children = OrderedDict()
+
+    def child(self, labels):
+        return self.kind(self.name, self.help, labels)
+
+    @property
+    def cumulative(self):
+        return self.kind.cumulative
+
+    def snapshot(self):
+        return [[list(values), child.snapshot()] for (values, child) in self.children.items()]
+
+    def fresh(self):
+        return type(self)(self.name, self.help, self.label)
+
+    def merge(self, snapshot):
+        for (values, child) in snapshot:
+            self.labels(*values).merge(child)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child == None:
+            labels = ','.join(['{0}="{1}"'.format(l, v) for (l, v) in zip(self.label, values)])
+            child = self.child(labels)
+            self.children[values] = child
+        return child
+
+    def report(self):
+        kind = {StatCounter: 'counter', StatGauge: 'gauge', StatHistogram: 'histogram'}[self.kind]
+        header = '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(self.name, self.help, kind)
+        return header + ''.join([c.report_samples() for c in self.children.values()])
+
+class StatCounterFamily(StatFamily):
+    kind = StatCounter
+
+class StatGaugeFamily(StatFamily):
+    kind = StatGauge
+
+    def __init__(self, name, help, label, aggregate='sum'):
+        StatFamily.__init__(self, name, help, label)
+        self.aggregate = aggregate
+
+    def child(self, labels):
+        return StatGauge(self.name, self.help, labels, self.aggregate)
+
+    def fresh(self):
+        return StatGaugeFamily(self.name, self.help, self.label, self.aggregate)
+
+class StatHistogramFamily(StatFamily):
+    kind = StatHistogram
+
+    def __init__(self, name, help, label, interval, bucket_count, bounds=None):
+        StatFamily.__init__(self, name, help, label)
+        if bounds == None:
+            bounds = [(i+1)*interval for i in range(0, bucket_count)]
+        self.bounds = bounds
+
+    def set_bounds(self, bounds):
+        self.bounds = list(bounds)
+        self.children = OrderedDict()
+
+    def child(self, labels):
+        return StatHistogram(self.name, self.help, None, None, labels, self.bounds)
+
+    def fresh(self):
+        return StatHistogramFamily(self.name, self.help, self.label, None, None, self.bounds)
 
 tilesrv_metrics_scraped = StatCounter('tilesrv_metrics_scraped', 'count of times scraped')
 tilesrv_aliveprobe = StatCounter('tilesrv_aliveprobe_count', 'count of times probe for aliveness')
 tilesrv_start = StatCounter('tilesrv_start_count', 'count of times tile server started')
 tile_served = StatCounter('tile_served_count', 'count of tiles served')
+tile_not_modified = StatCounter('tile_not_modified_count', 'count of tile requests answered 304 not modified')
 tile_exception = StatCounter('tile_exception_count', 'count of tiles requests that ended in exception')
 tile_queryfail = StatCounter('tile_queryfail_count', 'count of tiles requests that experienced query failure')
 
+tile_cache_hit = StatCounter('tile_cache_hit_count', 'count of tile requests served from the tile cache')
+tile_cache_miss = StatCounter('tile_cache_miss_count', 'count of tile requests that missed the tile cache')
+tile_cache_coalesced = StatCounter('tile_cache_coalesced_count', 'count of tile requests that waited on an in-flight generation of the same tile')
+tile_cache_eviction = StatCounter('tile_cache_eviction_count', 'count of tiles evicted from the tile cache to stay within budget')
+tile_cache_expired = StatCounter('tile_cache_expired_count', 'count of tiles dropped from the tile cache after their ttl')
+tile_cache_bytes = StatGauge('tile_cache_bytes', 'bytes of tile data held in the tile cache')
+tile_cache_entries = StatGauge('tile_cache_entries', 'count of tiles held in the tile cache')
+
+tile_store_hit = StatCounter('tile_store_hit_count', 'count of tiles read from the tile store')
+tile_store_miss = StatCounter('tile_store_miss_count', 'count of tiles not present in the tile store')
+tile_store_write = StatCounter('tile_store_write_count', 'count of tiles written to the tile store')
+tile_expired = StatCounter('tile_expired_count', 'count of tiles expired by imposm expire lists')
+tile_expire_lists = StatCounter('tile_expire_lists_count', 'count of imposm expire lists processed')
+tile_empty_hit = StatCounter('tile_empty_index_hit_count', 'count of tiles answered empty by the empty tile index')
+tile_outside = StatCounter('tile_outside_count', 'count of tile requests outside the served regions')
+tile_overview = StatCounter('tile_overview_count', 'count of overview tiles merged from zoom 16 tiles')
+tile_empty_entries = StatGauge('tile_empty_index_entries', 'count of tiles known to be empty', aggregate='max')
+
 tile_querytime = StatHistogram('tile_querytime_seconds', 'histogram of tile query performance', 0.20, 20)
-tile_size = StatHistogram('tile_size', 'histogram of tile size', 1024 * 8, 32)
+tile_pool_acquire = StatHistogram('tile_pool_acquire_seconds', 'histogram of time waiting to acquire a pool connection', 0.005, 20)
+tile_pool_unhealthy = StatCounter('tile_pool_unhealthy_count', 'count of idle pool connections that failed a health check')
+tile_shed_queue = StatCounter('tile_shed_queue_count', 'count of tile requests shed because the admission queue was full')
+tile_shed_deadline = StatCounter('tile_shed_deadline_count', 'count of tile requests shed because their deadline could not be met')
+tile_admit_active = StatGauge('tile_admission_active', 'tile requests admitted to generate')
+tile_admit_waiting = StatGauge('tile_admission_waiting', 'tile requests queued for admission')
+tile_streamed = StatCounter('tile_streamed_count', 'count of tiles streamed from a server side cursor')
+tile_offload = StatCounter('tile_offload_count', 'count of tiles serialized or compressed in the offload executor')
+tile_offload_pending = StatGauge('tile_offload_pending', 'tiles queued or being serialized or compressed in the offload executor')
+tile_offload_time = StatHistogram('tile_offload_seconds', 'histogram of time to serialize or compress an offloaded tile including queueing', 0.005, 20)
+tile_phase = StatHistogramFamily('tile_phase_seconds', 'histogram of time spent in each phase of tile requests by outcome', ['phase', 'status'], None, None, exponential_buckets(0.0005, 2, 16))
+tile_backend_time = StatHistogramFamily('tile_backend_seconds', 'histogram of time tile requests held a database connection by backend', 'backend', None, None, exponential_buckets(0.0005, 2, 16))
+tile_backend_errors = StatCounterFamily('tile_backend_error_count', 'count of connection failures of tile requests and health checks by backend', 'backend')
+tile_backend_outstanding = StatGaugeFamily('tile_backend_outstanding', 'tile requests holding or waiting for a database connection by backend', 'backend')
+tile_backend_ejected = StatGaugeFamily('tile_backend_ejected', 'backends currently ejected or skipped for replication lag by any worker', 'backend', aggregate='max')
+tile_size = StatHistogramFamily('tile_size', 'histogram of tile size by content encoding', 'encoding', 1024 * 8, 32)
 
 # Metrics
 #  - scrapes - counter
@@ -94,35 +322,998 @@ metrics = [
     tilesrv_aliveprobe,
     tilesrv_start,
     tile_served,
+    tile_not_modified,
     tile_exception,
     tile_queryfail,
+    tile_cache_hit,
+    tile_cache_miss,
+    tile_cache_coalesced,
+    tile_cache_eviction,
+    tile_cache_expired,
+    tile_cache_bytes,
+    tile_cache_entries,
+    tile_store_hit,
+    tile_store_miss,
+    tile_store_write,
+    tile_expired,
+    tile_expire_lists,
+    tile_empty_hit,
+    tile_empty_entries,
+    tile_outside,
+    tile_overview,
     tile_querytime,
+    tile_pool_acquire,
+    tile_phase,
+    tile_shed_queue,
+    tile_shed_deadline,
+    tile_admit_active,
+    tile_admit_waiting,
+    tile_streamed,
+    tile_offload,
+    tile_offload_pending,
+    tile_offload_time,
+    tile_pool_unhealthy,
+    tile_backend_time,
+    tile_backend_errors,
+    tile_backend_outstanding,
+    tile_backend_ejected,
     tile_size
 ]
 
+TileCacheEntry = namedtuple('tilecacheentry', 'data expires')
 TileGen = namedtuple('tilegen', 'count generator')
 TileResult = namedtuple('tileresult', 'cost zoom x y data')
 TileCloudStat = namedtuple('tilecloud', 'generated uploaded cost upload_cost')
 
+#
+# Time spent in each phase of one tile request: pool acquire, statement
+# setup, query, fetch, python assembly, serialization and response write.
+# mark(phase) charges the time since the previous mark to phase; phases
+# are only observed once the outcome of the request is known.  The timer
+# also carries the request's deadline, on the time.monotonic() clock,
+# down to admission and the statement timeout.
+#
+
+class PhaseTimer(object):
+    def __init__(self, deadline=None):
+        self.phases = OrderedDict()
+        self.start = self.last = time.perf_counter()
+        self.deadline = deadline
+
+    # milliseconds left before the deadline, None without one
+    def remaining_ms(self):
+        if self.deadline == None:
+            return None
+        return max(1, int((self.deadline - time.monotonic()) * 1000))
+
+    def restart(self):
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def observe(self, status):
+        for (phase, seconds) in self.phases.items():
+            tile_phase.labels(phase, status).sample(seconds)
+        tile_phase.labels('total', status).sample(time.perf_counter() - self.start)
+
 zoom_default = 16
 connection_pooling = True
 
+empty_tile_data = b'{"features": [], "type": "FeatureCollection"}'
+
+#
+# Pool connections are set up once when opened: statement timeout, search
+# path and a prepared plan for the tile query of each assembly in use, so
+# a tile costs one round trip that skips parsing and planning.
+#
+
+tile_prepare = {
+    'python': "PREPARE soundscape_tile_plan (int, int, int) AS SELECT * from soundscape_tile($1, $2, $3)",
+    'database': "PREPARE soundscape_tile_json_plan (int, int, int) AS SELECT soundscape_tile_json($1, $2, $3)",
+    'mvt': "PREPARE soundscape_tile_mvt_plan (int, int, int) AS SELECT soundscape_tile_mvt($1, $2, $3)",
+}
+
 tile_query = """
-    SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+    EXECUTE soundscape_tile_plan (%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+tile_json_query = """
+    EXECUTE soundscape_tile_json_plan (%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+tile_mvt_query = """
+    EXECUTE soundscape_tile_mvt_plan (%(zoom)s, %(tile_x)s, %(tile_y)s)
 """
 
-timeout_set = "set statement_timeout=2000"
+timeout_set = "set statement_timeout={0}"
+
+# serving keeps tiles to 2s, offline generation has --generate_timeout
+async def tile_session_setup(conn, assemblies=None, statement_timeout=2000):
+    if assemblies == None:
+        assemblies = [args.assembly]
+        if args.mvt:
+            assemblies.append('mvt')
+    async with conn.cursor() as cursor:
+        await cursor.execute(timeout_set.format(statement_timeout))
+        if args.search_path:
+            await cursor.execute("SELECT set_config('search_path', %(search_path)s, false)", {'search_path': args.search_path})
+        for assembly in assemblies:
+            await cursor.execute(tile_prepare[assembly])
 
 def tile_name(zoom, x, y,):
     return '{0}/{1}/{2}.json'.format(zoom, x, y)
 
-async def gentile_async(cursor, zoom, x, y, gather_metrics=False):
+def mvt_name(zoom, x, y):
+    return '{0}/{1}/{2}.mvt'.format(zoom, x, y)
+
+def tile_coords(name):
+    return tuple(map(int, name[:-len('.json')].split('/')))
+
+# routes only match digits, so coordinates are never negative
+def tile_in_range(zoom, x, y):
+    return x < (1 << zoom) and y < (1 << zoom)
+
+#
+# Tile encoders turn the assembled FeatureCollection into canonical bytes.
+# The canonical form is what json.dumps(tile, sort_keys=True) produces, so
+# any other encoder must match it byte for byte (see --verify_encoders).
+#
+
+class JsonTileEncoder(object):
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(sort_keys=True)
+
+    def encode(self, obj):
+        return self.encoder.encode(obj).encode('utf-8')
+
+#
+# orjson differs from the canonical form in separators (',' vs ', '),
+# leaving non-ASCII and DEL unescaped and in float formatting ('1e-7' and
+# '0.00001' vs '1e-07' and '1e-05').  Its output is split on quotes into
+# structural and string parts; all structural parts are rewritten in one
+# pass by joining them on NUL, which cannot appear unescaped in JSON.  A
+# string holding an escaped quote would break the split, so such tiles
+# fall back to the stdlib encoder.
+#
+
+orjson_float_re = re.compile(rb'([\[ ])(-?0\.0000[0-9]+|-?[0-9]+(?:\.[0-9]+)?e[-+]?[0-9]+)')
+orjson_escape_re = re.compile(rb'\\\\|\\x([0-9a-f]{2})|\\U([0-9a-f]{8})')
+
+def orjson_float(match):
+    return match.group(1) + repr(float(match.group(2))).encode('ascii')
+
+# turns python's backslashreplace escapes into JSON \uXXXX escapes
+def orjson_escape(match):
+    if match.group(1) != None:
+        return b'\\u00' + match.group(1)
+    if match.group(2) != None:
+        c = int(match.group(2), 16) - 0x10000
+        return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | (c >> 10), 0xdc00 | (c & 0x3ff)).encode('ascii')
+    return match.group(0)
+
+class OrjsonTileEncoder(object):
+    name = 'orjson'
+
+    def __init__(self):
+        self.fallback = JsonTileEncoder()
+
+    def encode(self, obj):
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            # e.g. integers wider than 64 bits
+            return self.fallback.encode(obj)
+        if b'\\"' in data:
+            return self.fallback.encode(obj)
+        parts = data.split(b'"')
+        structure = b'\x00'.join(parts[0::2]).replace(b',', b', ').replace(b':', b': ')
+        if b'e' in structure or b' 0.0000' in structure or b'[0.0000' in structure or b'-0.0000' in structure:
+            structure = orjson_float_re.sub(orjson_float, structure)
+        parts[0::2] = structure.split(b'\x00')
+        if not data.isascii():
+            for i in range(1, len(parts), 2):
+                if not parts[i].isascii():
+                    parts[i] = orjson_escape_re.sub(orjson_escape, parts[i].decode('utf-8').encode('ascii', 'backslashreplace'))
+        data = b'"'.join(parts)
+        if b'\x7f' in data:
+            data = data.replace(b'\x7f', b'\\u007f')
+        return data
+
+tile_encoders = {'json': JsonTileEncoder}
+if orjson != None:
+    tile_encoders['orjson'] = OrjsonTileEncoder
+
+tile_encoder = JsonTileEncoder()
+
+#
+# Serializing a dense downtown tile can hold the event loop for tens of
+# milliseconds, so tiles of at least --offload_rows features are encoded
+# in an executor.  Encoders hold the GIL, so only a process pool truly
+# frees the loop; processes are spawned, created on first use in each
+# worker, and set up with the same encoder.
+#
+
+offload_executor = None
+
+def offload_init(encoder):
+    global tile_encoder
+    tile_encoder = tile_encoders[encoder]()
+
+def offload_encode(obj):
+    return tile_encoder.encode(obj)
+
+def offload_pool():
+    global offload_executor
+    if offload_executor == None:
+        if args.offload_executor == 'process':
+            offload_executor = ProcessPoolExecutor(args.offload_workers, multiprocessing.get_context('spawn'), offload_init, (args.encoder,))
+        else:
+            offload_executor = ThreadPoolExecutor(args.offload_workers)
+    return offload_executor
+
+async def tile_encode(obj, rows):
+    if args.offload_rows <= 0 or rows < args.offload_rows:
+        return tile_encoder.encode(obj)
+    tile_offload.inc()
+    tile_offload_pending.set(tile_offload_pending.value + 1)
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_event_loop().run_in_executor(offload_pool(), offload_encode, obj)
+    finally:
+        tile_offload_pending.set(tile_offload_pending.value - 1)
+        tile_offload_time.sample(time.perf_counter() - start)
+
+#
+# Tiles are canonical so a hash of the content is a strong validator that
+# is identical across tile servers and restarts.
+#
+
+class EncodedTile(object):
+    def __init__(self, data, gzip_data=None):
+        self.data = data
+        self.etag = '"{0}"'.format(hashlib.sha256(data).hexdigest()[:32])
+        # compressed once here and reused for every response of this tile
+        if gzip_data == None:
+            gzip_data = gzip.compress(data, compresslevel=6)
+        self.gzip = self.compressed(gzip_data)
+        self.br = None
+        if brotli != None:
+            self.br = self.compressed(brotli.compress(data, quality=5))
+        self.size = sum([len(v) for v in [self.data, self.gzip, self.br] if v != None])
+
+    def compressed(self, value):
+        # small tiles such as empty ones can grow when compressed
+        if len(value) < len(self.data):
+            return value
+        return None
+
+    def sample_sizes(self):
+        tile_size.labels('identity').sample(len(self.data))
+        if self.gzip != None:
+            tile_size.labels('gzip').sample(len(self.gzip))
+        if self.br != None:
+            tile_size.labels('br').sample(len(self.br))
+
+    def representation(self, encoding):
+        if encoding == 'br':
+            return (self.br, encoding_etag(self.etag, encoding))
+        elif encoding == 'gzip':
+            return (self.gzip, encoding_etag(self.etag, encoding))
+        return (self.data, self.etag)
+
+    def negotiate(self, accept_encoding):
+        available = [encoding for (encoding, value) in [('br', self.br), ('gzip', self.gzip)] if value != None]
+        return negotiate_encoding(accept_encoding, available)
+
+# each encoding is its own representation with its own validator
+def encoding_etag(etag, encoding):
+    if encoding == 'br':
+        return etag[:-1] + '-br"'
+    elif encoding == 'gzip':
+        return etag[:-1] + '-gz"'
+    return etag
+
+def encoding_compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    elif encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+# the available encoding with the highest q-value, None if all are refused
+def negotiate_encoding(accept_encoding, available):
+    if accept_encoding == None:
+        return 'identity'
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        params = coding.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[params[0].strip().lower()] = quality
+    # identity is acceptable unless refused, by name or by *, and loses
+    # ties, as do gzip to br among equal q-values
+    candidates = [(accepted.get('identity', accepted.get('*', 0.001)), 0, 'identity')]
+    for preference, encoding in [(2, 'br'), (1, 'gzip')]:
+        if encoding in available:
+            candidates.append((accepted.get(encoding, accepted.get('*', 0.0)), preference, encoding))
+    (quality, preference, encoding) = max(candidates)
+    if quality <= 0.0:
+        return None
+    return encoding
+
+# hashing and compressing a dense tile costs about as much as encoding it,
+# so tiles of at least --offload_bytes are built in the offload pool too
+async def tile_build(data, gzip_data=None):
+    if args.offload_bytes <= 0 or len(data) < args.offload_bytes:
+        return EncodedTile(data, gzip_data)
+    tile_offload.inc()
+    tile_offload_pending.set(tile_offload_pending.value + 1)
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_event_loop().run_in_executor(offload_pool(), EncodedTile, data, gzip_data)
+    finally:
+        tile_offload_pending.set(tile_offload_pending.value - 1)
+        tile_offload_time.sample(time.perf_counter() - start)
+
+def etag_matches(if_none_match, etag):
+    if if_none_match == None:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+# raised by an in-flight future whose tile could not be cached, e.g. a
+# streamed tile too large or cut short, so its waiters generate it themselves
+class TileUncached(Exception):
+    pass
+
+#
+# In-process LRU of encoded tiles bounded by total tile bytes.  Concurrent
+# misses for the same tile share a single generation task so that N
+# requests for a cold tile result in one query against the database.
+#
+
+class TileCache(object):
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.inflight = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry == None:
+            return None
+        if entry.expires <= time.monotonic():
+            self.remove(key)
+            tile_cache_expired.inc()
+            return None
+        self.entries.move_to_end(key)
+        return entry.data
+
+    def put(self, key, data):
+        self.remove(key)
+        if data.size > self.max_bytes:
+            return
+        self.entries[key] = TileCacheEntry(data, time.monotonic() + self.ttl)
+        self.size += data.size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.data.size
+            tile_cache_eviction.inc()
+        self.update_gauges()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.size -= entry.data.size
+            self.update_gauges()
+
+    # a generation under way may have read what is being invalidated, so it
+    # is forgotten: requests from now on start a new one and its result is
+    # not cached once it lands
+    def invalidate(self, key):
+        self.remove(key)
+        self.inflight.pop(key, None)
+
+    def update_gauges(self):
+        tile_cache_bytes.set(self.size)
+        tile_cache_entries.set(len(self.entries))
+
+    def generation_done(self, key, task):
+        failed = task.cancelled() or task.exception() != None
+        if self.inflight.get(key) != task:
+            return
+        del self.inflight[key]
+        if failed:
+            return
+        data = task.result()
+        if data != None:
+            self.put(key, data)
+
+    async def get_or_generate(self, key, generate):
+        data = self.get(key)
+        if data != None:
+            tile_cache_hit.inc()
+            return data
+        task = self.inflight.get(key)
+        if task == None:
+            tile_cache_miss.inc()
+            # N.B. the generation runs as its own task so a disconnecting
+            #      client does not cancel the work other requests wait on
+            task = asyncio.ensure_future(generate())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.generation_done(key, t))
+        else:
+            tile_cache_coalesced.inc()
+        try:
+            return await asyncio.shield(task)
+        except TileUncached:
+            return await self.get_or_generate(key, generate)
+
+    #
+    # As get_or_generate for a set of tiles, where generate_many produces all
+    # missing tiles at once and returns them keyed like its argument.  Each
+    # missing tile gets its own in-flight future so single tile requests
+    # arriving meanwhile wait on the batch rather than querying again.
+    #
+
+    async def get_or_generate_many(self, keys, generate_many):
+        loop = asyncio.get_event_loop()
+        results = {}
+        waiting = {}
+        missing = []
+        for key in keys:
+            data = self.get(key)
+            if data != None:
+                tile_cache_hit.inc()
+                results[key] = data
+            elif key in self.inflight:
+                tile_cache_coalesced.inc()
+                waiting[key] = self.inflight[key]
+            else:
+                tile_cache_miss.inc()
+                missing.append(key)
+        if len(missing) > 0:
+            futures = {}
+            for key in missing:
+                future = loop.create_future()
+                future.add_done_callback(lambda f, key=key: self.generation_done(key, f))
+                self.inflight[key] = future
+                futures[key] = future
+                waiting[key] = future
+            batch = asyncio.ensure_future(generate_many(missing))
+            batch.add_done_callback(lambda b: self.batch_done(futures, b))
+        uncached = []
+        for key, task in waiting.items():
+            try:
+                results[key] = await asyncio.shield(task)
+            except TileUncached:
+                uncached.append(key)
+        if len(uncached) > 0:
+            results.update(await self.get_or_generate_many(uncached, generate_many))
+        return results
+
+    #
+    # A streamed tile is generated outside get_or_generate but registers an
+    # in-flight future all the same, so requests arriving meanwhile wait for
+    # it and are served from the cache rather than each streaming a query.
+    # The streaming request resolves the future itself.
+    #
+
+    def stream_begin(self, key):
+        tile_cache_miss.inc()
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(lambda f: self.generation_done(key, f))
+        self.inflight[key] = future
+        return future
+
+    def batch_done(self, futures, batch):
+        for key, future in futures.items():
+            if batch.cancelled():
+                future.cancel()
+            elif batch.exception() != None:
+                future.set_exception(batch.exception())
+            else:
+                future.set_result(batch.result().get(key))
+
+#
+# Version and content hash of every stored tile.  A tile's version only
+# advances when it is written with different content, so regenerating an
+# unchanged tile is free to publish.  Stores write tiles from executor
+# threads, hence the lock around the shared connection, which a store may
+# share to hold it across its own statements.
+#
+
+class TileManifest(object):
+    def __init__(self, db, lock=None):
+        self.db = db
+        self.lock = threading.RLock() if lock == None else lock
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifest (zoom integer, x integer, y integer, version integer, hash text, updated text)')
+        self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS manifest_index ON manifest (zoom, x, y)')
+        self.db.commit()
+
+    def get(self, zoom, x, y):
+        with self.lock:
+            return self.db.execute('SELECT version, hash FROM manifest WHERE zoom=? AND x=? AND y=?', (zoom, x, y)).fetchone()
+
+    # returns True when the content of the tile changed
+    def record(self, zoom, x, y, data, commit=True):
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            row = self.db.execute('SELECT version, hash FROM manifest WHERE zoom=? AND x=? AND y=?', (zoom, x, y)).fetchone()
+            if row != None and row[1] == digest:
+                return False
+            version = 1 if row == None else row[0] + 1
+            self.db.execute('INSERT OR REPLACE INTO manifest (zoom, x, y, version, hash, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                            (zoom, x, y, version, digest, datetime.utcnow().isoformat()))
+            if commit:
+                self.db.commit()
+            return True
+
+    def hashes(self):
+        with self.lock:
+            return dict([(tile_name(r[0], r[1], r[2]), r[3]) for r in self.db.execute('SELECT zoom, x, y, hash FROM manifest')])
+
+    def remove(self, zoom, x, y, commit=True):
+        with self.lock:
+            self.db.execute('DELETE FROM manifest WHERE zoom=? AND x=? AND y=?', (zoom, x, y))
+            if commit:
+                self.db.commit()
+
+#
+# Persistent store of canonical tiles laid out as zoom/x/y.json.  Tiles are
+# written to a temporary file and renamed into place so readers never see
+# a partially written tile.
+#
+
+class TileStore(object):
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        db = sqlite3.connect(os.path.join(root, '.manifest.sqlite'), timeout=60, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # N.B. every --generate process commits a manifest row per tile, so
+        #      as in TileArchive commits are not each synced to disk
+        db.execute('PRAGMA synchronous=NORMAL')
+        self.manifest = TileManifest(db)
+
+    def close(self):
+        self.manifest.db.close()
+
+    def tile_path(self, zoom, x, y):
+        return os.path.join(self.root, tile_name(zoom, x, y))
+
+    def read(self, zoom, x, y):
+        try:
+            with open(self.tile_path(zoom, x, y), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, zoom, x, y, data):
+        path = self.tile_path(zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        tile_store_write.inc()
+        return self.manifest.record(zoom, x, y, data)
+
+    def remove(self, zoom, x, y):
+        try:
+            os.remove(self.tile_path(zoom, x, y))
+        except FileNotFoundError:
+            return False
+        self.manifest.remove(zoom, x, y)
+        return True
+
+    async def read_async(self, zoom, x, y):
+        return await asyncio.get_event_loop().run_in_executor(None, self.read, zoom, x, y)
+
+    async def read_tile_async(self, zoom, x, y):
+        data = await self.read_async(zoom, x, y)
+        if data == None:
+            return None
+        return await tile_build(data)
+
+    async def write_async(self, zoom, x, y, data):
+        return await asyncio.get_event_loop().run_in_executor(None, self.write, zoom, x, y, data)
+
+    async def remove_async(self, zoom, x, y):
+        return await asyncio.get_event_loop().run_in_executor(None, self.remove, zoom, x, y)
+
+    def checkpoint(self, region):
+        return GenerateCheckpoint(os.path.join(self.root, '.generate', '{0}.columns'.format(region)))
+
+#
+# Single file MBTiles archive of gzip compressed tiles.  Rows are keyed by
+# (zoom_level, tile_column, tile_row) with the row flipped as MBTiles uses
+# TMS numbering.  Read only archives are opened with a large mmap so
+# lookups are served from the page cache and cheap enough to run directly
+# on the event loop; one connection is shared by all requests.  Writable
+# archives compress and write tiles in executor threads, where a commit
+# may wait on the disk, so all their statements hold the manifest lock.
+#
+
+class TileArchive(object):
+    def __init__(self, path, readonly=False, mmap_size=1024 * 1024 * 1024):
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.RLock()
+        if readonly:
+            self.db = sqlite3.connect('file:{0}?mode=ro'.format(path), uri=True)
+            self.db.execute('PRAGMA query_only=1')
+        else:
+            self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name text, value text)')
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS generate_columns (region text, tile_column integer)')
+            # N.B. tile_row here is the XYZ row of the failed tile, not TMS
+            self.db.execute('CREATE TABLE IF NOT EXISTS generate_failed (region text, tile_column integer, tile_row integer)')
+            self.db.commit()
+            self.manifest = TileManifest(self.db, self.lock)
+        self.db.execute('PRAGMA mmap_size={0}'.format(int(mmap_size)))
+
+    def close(self):
+        self.db.close()
+
+    def tms_row(self, zoom, y):
+        return (1 << zoom) - 1 - y
+
+    def metadata(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT name, value FROM metadata').fetchall())
+
+    def set_metadata(self, values):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', [(k, str(v)) for k, v in values.items()])
+            self.db.commit()
+
+    def read_blob(self, zoom, x, y):
+        with self.lock:
+            row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (zoom, x, self.tms_row(zoom, y))).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def read(self, zoom, x, y):
+        blob = self.read_blob(zoom, x, y)
+        if blob == None:
+            return None
+        return gzip.decompress(blob)
+
+    def write(self, zoom, x, y, data):
+        # N.B. compressed before taking the lock, zlib releases the GIL
+        blob = gzip.compress(data, compresslevel=9)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)', (zoom, x, self.tms_row(zoom, y), blob))
+            changed = self.manifest.record(zoom, x, y, data, commit=False)
+            self.db.commit()
+        tile_store_write.inc()
+        return changed
+
+    def remove(self, zoom, x, y):
+        with self.lock:
+            cursor = self.db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (zoom, x, self.tms_row(zoom, y)))
+            self.manifest.remove(zoom, x, y, commit=False)
+            self.db.commit()
+        return cursor.rowcount > 0
+
+    # a writable archive may be waiting on a commit in another thread, so
+    # only read only archives are read on the event loop
+    async def read_async(self, zoom, x, y):
+        if self.readonly:
+            return self.read(zoom, x, y)
+        return await asyncio.get_event_loop().run_in_executor(None, self.read, zoom, x, y)
+
+    async def read_tile_async(self, zoom, x, y):
+        if self.readonly:
+            blob = self.read_blob(zoom, x, y)
+        else:
+            blob = await asyncio.get_event_loop().run_in_executor(None, self.read_blob, zoom, x, y)
+        if blob == None:
+            return None
+        return await tile_build(gzip.decompress(blob), blob)
+
+    async def write_async(self, zoom, x, y, data):
+        return await asyncio.get_event_loop().run_in_executor(None, self.write, zoom, x, y, data)
+
+    async def remove_async(self, zoom, x, y):
+        return await asyncio.get_event_loop().run_in_executor(None, self.remove, zoom, x, y)
+
+    def checkpoint(self, region):
+        return ArchiveCheckpoint(self.db, region, self.lock)
+
+def open_store(path, readonly=False):
+    if path.endswith('.mbtiles'):
+        return TileArchive(path, readonly)
+    return TileStore(path)
+
+def expire_checkpoint_path(store_path):
+    if store_path.endswith('.mbtiles'):
+        return store_path + '.expire_checkpoint'
+    return os.path.join(store_path, '.expire_checkpoint')
+
+#
+# Tile ranges of the regions served, from their extracts.json bboxes.
+# Deployments serve a handful of regions so testing each rectangle is a
+# few integer comparisons, far cheaper than any query.
+#
+
+class TileCoverage(object):
+    def __init__(self, zoom, bboxes):
+        self.ranges = [tile_bbox_from_coords(zoom, bbox) for bbox in bboxes]
+
+    def contains(self, x, y):
+        for (minx, miny, maxx, maxy) in self.ranges:
+            if minx <= x <= maxx and miny <= y <= maxy:
+                return True
+        return False
+
+#
+# Set of z16 tiles known to be empty.  A z16 column holds 65536 tiles, the
+# size of a roaring bitmap chunk, so each x column is a roaring container:
+# a sorted array of y while sparse and a bitmap once more than 4096 of its
+# tiles are empty.  Saved as the last expire list applied to the index,
+# then x, kind, count and the container per column.
+#
+
+class EmptyTileIndex(object):
+    array_max = 4096
+    bitmap_bytes = 65536 // 8
+    header = b'SSEMPTY2'
+    header_v1 = b'SSEMPTY1'
+
+    def __init__(self):
+        self.columns = {}
+        self.count = 0
+        self.dirty = False
+        # last expire list applied, None when unknown
+        self.checkpoint = None
+
+    def contains(self, x, y):
+        c = self.columns.get(x)
+        if c == None:
+            return False
+        if isinstance(c, bytearray):
+            return c[y >> 3] & (1 << (y & 7)) != 0
+        i = bisect_left(c, y)
+        return i < len(c) and c[i] == y
+
+    def add(self, x, y):
+        c = self.columns.get(x)
+        if c == None:
+            c = self.columns[x] = array('H')
+        if isinstance(c, bytearray):
+            if c[y >> 3] & (1 << (y & 7)) != 0:
+                return
+            c[y >> 3] |= 1 << (y & 7)
+        else:
+            i = bisect_left(c, y)
+            if i < len(c) and c[i] == y:
+                return
+            c.insert(i, y)
+            if len(c) > self.array_max:
+                self.columns[x] = self.to_bitmap(c)
+        self.count += 1
+        self.dirty = True
+        self.update_gauges()
+
+    def discard(self, x, y):
+        c = self.columns.get(x)
+        if c == None:
+            return
+        if isinstance(c, bytearray):
+            if c[y >> 3] & (1 << (y & 7)) == 0:
+                return
+            c[y >> 3] &= ~(1 << (y & 7)) & 0xff
+        else:
+            i = bisect_left(c, y)
+            if i == len(c) or c[i] != y:
+                return
+            del c[i]
+            if len(c) == 0:
+                del self.columns[x]
+        self.count -= 1
+        self.dirty = True
+        self.update_gauges()
+
+    def to_bitmap(self, ys):
+        bitmap = bytearray(self.bitmap_bytes)
+        for y in ys:
+            bitmap[y >> 3] |= 1 << (y & 7)
+        return bitmap
+
+    def save(self, path):
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(self.header)
+            checkpoint = (self.checkpoint or '').encode('utf-8')
+            f.write(struct.pack('<H', len(checkpoint)))
+            f.write(checkpoint)
+            for x in sorted(self.columns.keys()):
+                c = self.columns[x]
+                if isinstance(c, bytearray):
+                    f.write(struct.pack('<HBI', x, 1, 0))
+                    f.write(c)
+                else:
+                    f.write(struct.pack('<HBI', x, 0, len(c)))
+                    f.write(c.tobytes())
+        os.replace(temp_path, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            header = f.read(len(cls.header))
+            if header == cls.header:
+                (length,) = struct.unpack('<H', f.read(2))
+                index.checkpoint = f.read(length).decode('utf-8') or None
+            elif header != cls.header_v1:
+                raise ValueError('{0} is not an empty tile index'.format(path))
+            while True:
+                column = f.read(struct.calcsize('<HBI'))
+                if len(column) == 0:
+                    break
+                (x, kind, count) = struct.unpack('<HBI', column)
+                if kind == 1:
+                    c = bytearray(f.read(cls.bitmap_bytes))
+                    index.count += sum([bin(b).count('1') for b in c])
+                else:
+                    c = array('H')
+                    c.frombytes(f.read(count * 2))
+                    index.count += count
+                index.columns[x] = c
+        return index
+
+    def set_checkpoint(self, checkpoint):
+        if checkpoint != self.checkpoint:
+            self.checkpoint = checkpoint
+            self.dirty = True
+
+    def update_gauges(self):
+        tile_empty_entries.set(self.count)
+
+# lines of 'zoom/x/y' as written in imposm expire lists
+def read_tile_list(f):
+    tiles = []
+    for line in f:
+        parts = line.strip().split('/')
+        if len(parts) != 3:
+            continue
+        tiles.append(tuple(map(int, parts)))
+    return tiles
+
+#
+# imposm writes the z16 tiles touched by each applied diff into
+# expiredir/YYYYMMDD/HHMMSS.mmm.tiles, one 'zoom/x/y' per line.  Lists
+# sort chronologically by path so progress is a single checkpoint of the
+# last list consumed.
+#
+
+class ExpireWatcher(object):
+    def __init__(self, expiredir, checkpoint_path=None, settle_time=5):
+        self.expiredir = expiredir
+        self.checkpoint_path = checkpoint_path
+        self.settle_time = settle_time
+        self.last = ''
+        if checkpoint_path != None:
+            try:
+                with open(checkpoint_path, 'r') as f:
+                    self.last = f.read().strip()
+            except FileNotFoundError:
+                pass
+
+    def scan(self):
+        lists = []
+        now = time.time()
+        last_dir = os.path.dirname(self.last)
+        for dirpath, dirnames, filenames in os.walk(self.expiredir):
+            # date directories before the checkpoint's hold only consumed lists
+            if dirpath == self.expiredir:
+                dirnames[:] = [d for d in dirnames if d >= last_dir]
+            for filename in filenames:
+                if not filename.endswith('.tiles'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.expiredir)
+                if name <= self.last:
+                    continue
+                # imposm may still be appending to the newest list
+                if now - os.path.getmtime(path) < self.settle_time:
+                    continue
+                lists.append(name)
+        return sorted(lists)
+
+    def read_tiles(self, lists):
+        tiles = set()
+        for name in lists:
+            with open(os.path.join(self.expiredir, name), 'r') as f:
+                tiles.update(read_tile_list(f))
+        return tiles
+
+    def commit(self, lists):
+        if len(lists) == 0:
+            return
+        self.last = lists[-1]
+        for name in lists:
+            tile_expire_lists.inc()
+        if self.checkpoint_path != None:
+            temp_path = '{0}.{1}.tmp'.format(self.checkpoint_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                f.write(self.last)
+            os.replace(temp_path, self.checkpoint_path)
+
+# Expire lists written while the server was down, e.g. during a deploy,
+# may have given features to tiles of a saved index.  Every worker forgets
+# those tiles before serving, from the lists after the index checkpoint
+# (all of them when it is unknown).
+def empty_index_replay(index, expiredir):
+    watcher = ExpireWatcher(expiredir)
+    watcher.last = index.checkpoint or ''
+    lists = watcher.scan()
+    for (zoom, x, y) in watcher.read_tiles(lists):
+        if zoom == zoom_default:
+            index.discard(x, y)
+    if len(lists) > 0:
+        index.set_checkpoint(lists[-1])
+    return lists
+
+#
+# A deadline becomes the statement timeout of the query, set in the same
+# round trip.  It is SET LOCAL in a transaction so it ends with the query
+# and is never left behind on the pooled connection, whose session timeout
+# stays at timeout_set.  tile_query_end ends the transaction, also after a
+# failed query.
+#
+
+def tile_query_with_timeout(query, timer):
+    timeout_ms = timer.remaining_ms()
+    if timeout_ms == None:
+        return query
+    return 'BEGIN; set local statement_timeout={0}; {1}'.format(timeout_ms, query)
+
+async def tile_query_end(cursor, timer):
+    if timer.deadline != None:
+        await cursor.execute('COMMIT')
+
+async def gentile_async(cursor, zoom, x, y, gather_metrics=False, timer=None):
+    if timer == None:
+        timer = PhaseTimer()
     try:
         if gather_metrics:
             query_start = time.perf_counter()
-        await cursor.execute(timeout_set)
-        await cursor.execute(tile_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
-        value = await cursor.fetchall()
+        timer.restart()
+        try:
+            await cursor.execute(tile_query_with_timeout(tile_query, timer), {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+            timer.mark('query')
+            value = await cursor.fetchall()
+        finally:
+            await tile_query_end(cursor, timer)
+        timer.mark('fetch')
         if gather_metrics:
             query_end = time.perf_counter()
             tile_querytime.sample(query_end - query_start)
@@ -132,58 +1323,1055 @@ async def gentile_async(cursor, zoom, x, y, gather_metrics=False):
             'type': 'FeatureCollection',
             'features': list(map(lambda x: x._asdict(), value))
         }
-        tile = json.dumps(obj, sort_keys=True)
+        timer.mark('assembly')
+        tile = await tile_encode(obj, len(value))
+        timer.mark('serialize')
+        return tile
+    except psycopg2.Error as e:
+        log_event(logging.ERROR, 'query failed', error=str(e))
+        raise
+
+# the tile is assembled and serialized by soundscape_tile_json in the database
+async def gentile_json_async(cursor, zoom, x, y, gather_metrics=False, timer=None):
+    if timer == None:
+        timer = PhaseTimer()
+    try:
+        if gather_metrics:
+            query_start = time.perf_counter()
+        timer.restart()
+        try:
+            await cursor.execute(tile_query_with_timeout(tile_json_query, timer), {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+            timer.mark('query')
+            value = await cursor.fetchone()
+        finally:
+            await tile_query_end(cursor, timer)
+        timer.mark('fetch')
         if gather_metrics:
-            tile_size.sample(len(tile))
+            query_end = time.perf_counter()
+            tile_querytime.sample(query_end - query_start)
+        tile = value[0].encode('utf-8')
+        timer.mark('serialize')
         return tile
     except psycopg2.Error as e:
-        print(e)
+        log_event(logging.ERROR, 'query failed', error=str(e))
         raise
 
-async def tile_handler_on_conn(conn, request):
-    start = datetime.utcnow()
+#
+# Batches of tiles are generated by one set returning query on one
+# connection.  WITH ORDINALITY keeps each tile's features in the order
+# soundscape_tile returns them so batched tiles are identical to tiles
+# generated one at a time.
+#
+
+tile_many_query = """
+    SELECT t.tile_x, t.tile_y, f.type, f.osm_ids, f.feature_type, f.feature_value, f.geometry, f.properties
+      FROM unnest(%(tile_x)s::int[], %(tile_y)s::int[]) AS t(tile_x, tile_y)
+      CROSS JOIN LATERAL soundscape_tile(%(zoom)s, t.tile_x, t.tile_y) WITH ORDINALITY AS f(type, osm_ids, feature_type, feature_value, geometry, properties, n)
+      ORDER BY t.tile_x, t.tile_y, f.n
+"""
+
+tile_json_many_query = """
+    SELECT t.tile_x, t.tile_y, soundscape_tile_json(%(zoom)s, t.tile_x, t.tile_y)
+      FROM unnest(%(tile_x)s::int[], %(tile_y)s::int[]) AS t(tile_x, tile_y)
+"""
+
+# a batch gets the time of its tiles one by one, but not beyond its deadline
+def tile_many_with_timeout(query, count, timer):
+    timeout_ms = 2000 * count
+    if timer != None and timer.remaining_ms() != None:
+        timeout_ms = min(timeout_ms, timer.remaining_ms())
+    return 'BEGIN; set local statement_timeout={0}; {1}'.format(timeout_ms, query)
+
+async def gentile_many_async(cursor, zoom, coords, timer=None):
+    try:
+        try:
+            await cursor.execute(tile_many_with_timeout(tile_many_query, len(coords), timer), {'zoom': int(zoom), 'tile_x': [c[0] for c in coords], 'tile_y': [c[1] for c in coords]})
+            value = await cursor.fetchall()
+        finally:
+            await cursor.execute('COMMIT')
+        features = dict([(c, []) for c in coords])
+        for r in value:
+            features[(r.tile_x, r.tile_y)].append({
+                'type': r.type,
+                'osm_ids': r.osm_ids,
+                'feature_type': r.feature_type,
+                'feature_value': r.feature_value,
+                'geometry': r.geometry,
+                'properties': r.properties,
+            })
+        tiles = {}
+        for c in coords:
+            tiles[c] = await tile_encode({'type': 'FeatureCollection', 'features': features[c]}, len(features[c]))
+        return tiles
+    except psycopg2.Error as e:
+        log_event(logging.ERROR, 'query failed', error=str(e))
+        raise
+
+async def gentile_json_many_async(cursor, zoom, coords, timer=None):
+    try:
+        try:
+            await cursor.execute(tile_many_with_timeout(tile_json_many_query, len(coords), timer), {'zoom': int(zoom), 'tile_x': [c[0] for c in coords], 'tile_y': [c[1] for c in coords]})
+            value = await cursor.fetchall()
+        finally:
+            await cursor.execute('COMMIT')
+        return dict([((r[0], r[1]), r[2].encode('utf-8')) for r in value])
+    except psycopg2.Error as e:
+        log_event(logging.ERROR, 'query failed', error=str(e))
+        raise
+
+# the Mapbox Vector Tile is built by soundscape_tile_mvt in the database
+async def gentile_mvt_async(cursor, zoom, x, y, timer):
+    try:
+        timer.restart()
+        try:
+            await cursor.execute(tile_query_with_timeout(tile_mvt_query, timer), {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+            timer.mark('query')
+            value = await cursor.fetchone()
+        finally:
+            await tile_query_end(cursor, timer)
+        timer.mark('fetch')
+        return bytes(value[0])
+    except psycopg2.Error as e:
+        log_event(logging.ERROR, 'query failed', error=str(e))
+        raise
+
+async def tile_handler_on_conn(conn, zoom, x, y, timer=None):
+    if timer == None:
+        timer = PhaseTimer()
+    timer.restart()
     async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
-        zoom = request.match_info['zoom']
-        if int(zoom) != zoom_default:
+        timer.mark('setup')
+        if args.assembly == 'database':
+            return await gentile_json_async(cursor, zoom, x, y, True, timer)
+        return await gentile_async(cursor, zoom, x, y, True, timer)
+
+#
+# Admission control in front of the pool: at most --admit_limit requests
+# generate at once and at most --admit_queue wait for a turn.  Requests
+# beyond the queue, or that could not start before their deadline, are
+# shed at once with a 503 rather than piling up on the pool.  A finishing
+# request hands its slot straight to the oldest waiter.
+#
+
+class TileOverloaded(Exception):
+    pass
+
+class TileAdmission(object):
+    def __init__(self, limit, queue_max, min_query_time):
+        self.limit = limit
+        self.queue_max = queue_max
+        self.min_query_time = min_query_time
+        self.active = 0
+        self.waiters = deque()
+
+    async def enter(self, deadline):
+        if self.active < self.limit and len(self.waiters) == 0:
+            self.active += 1
+            self.update_gauges()
+            return
+        if len(self.waiters) >= self.queue_max:
+            tile_shed_queue.inc()
+            raise TileOverloaded('admission queue full')
+        wait = None
+        if deadline != None:
+            wait = deadline - time.monotonic() - self.min_query_time
+            if wait <= 0:
+                tile_shed_deadline.inc()
+                raise TileOverloaded('deadline too close')
+        turn = asyncio.get_event_loop().create_future()
+        self.waiters.append(turn)
+        self.update_gauges()
+        try:
+            await asyncio.wait_for(turn, wait)
+        except asyncio.TimeoutError:
+            tile_shed_deadline.inc()
+            raise TileOverloaded('deadline passed waiting for admission')
+        except BaseException:
+            # a slot handed over just as the waiter went away is passed on
+            if turn.done() and not turn.cancelled():
+                self.exit()
+            raise
+        finally:
+            if turn in self.waiters:
+                self.waiters.remove(turn)
+            self.update_gauges()
+
+    def exit(self):
+        while len(self.waiters) > 0:
+            turn = self.waiters.popleft()
+            if not turn.done():
+                turn.set_result(None)
+                self.update_gauges()
+                return
+        self.active -= 1
+        self.update_gauges()
+
+    def update_gauges(self):
+        tile_admit_active.set(self.active)
+        tile_admit_waiting.set(len(self.waiters))
+
+#
+# Tile queries are spread over one pool per --dsn, typically a primary
+# and its read replicas.  Each query goes to the available backend with
+# the fewest requests outstanding, ties broken at random.  A backend is
+# ejected for --eject_seconds after --eject_failures connection failures
+# in a row, and a replica more than --max_lag seconds behind is skipped
+# until it catches up.  Backends are checked every --pool_health_interval,
+# which also retries pools that could not be opened at startup and lets
+# an ejected backend back in as soon as it answers again.
+#
+
+backend_lag_query = '''SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END'''
+
+# statement timeouts are the request running out of time, not the backend failing
+def backend_failure(exc):
+    if isinstance(exc, psycopg2.extensions.QueryCanceledError):
+        return False
+    return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+# N.B. host:port/dbname, so the password never reaches logs or metrics
+def backend_label(dsn):
+    params = psycopg2.extensions.parse_dsn(dsn)
+    return '{0}:{1}/{2}'.format(params.get('host', 'local'), params.get('port', '5432'), params.get('dbname', ''))
+
+class TileBackend(object):
+    def __init__(self, dsn, eject_failures, eject_seconds):
+        self.dsn = dsn
+        self.label = backend_label(dsn)
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.pool = None
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self.lag = 0.0
+        self.lagging = False
+
+    async def open(self, minsize, maxsize):
+        if connection_pooling and self.pool == None:
+            # N.B. minsize connections are opened, and set up, before serving
+            self.pool = await tile_pool_create(self.dsn, minsize, maxsize)
+
+    async def close(self):
+        if self.pool != None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+    def usable(self):
+        return self.pool != None or not connection_pooling
+
+    def available(self, now, max_lag):
+        return self.usable() and self.ejected_until <= now and self.lag <= max_lag
+
+    async def acquire(self):
+        if connection_pooling:
+            start = time.perf_counter()
+            conn = await self.pool.acquire()
+            tile_pool_acquire.sample(time.perf_counter() - start)
+            return conn
+        conn = await aiopg.connect(self.dsn)
+        try:
+            await tile_session_setup(conn)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def release(self, conn):
+        if connection_pooling:
+            await self.pool.release(conn)
+        else:
+            await conn.close()
+
+    def begin(self):
+        self.outstanding += 1
+        tile_backend_outstanding.labels(self.label).set(self.outstanding)
+
+    def end(self):
+        self.outstanding -= 1
+        tile_backend_outstanding.labels(self.label).set(self.outstanding)
+
+    def succeeded(self):
+        self.failures = 0
+        if self.ejected_until > 0:
+            always_log('backend {0} restored'.format(self.label))
+            self.ejected_until = 0
+            self.update_gauge()
+
+    def failed(self, e):
+        tile_backend_errors.labels(self.label).inc()
+        self.failures += 1
+        if self.failures >= self.eject_failures:
+            self.eject(e)
+
+    def eject(self, e):
+        always_log('BACKEND EJECTED {0} for {1}s: {2}'.format(self.label, self.eject_seconds, e))
+        self.failures = 0
+        self.ejected_until = time.monotonic() + self.eject_seconds
+        self.update_gauge()
+
+    def set_lag(self, lag, max_lag):
+        self.lag = lag
+        lagging = lag > max_lag
+        if lagging != self.lagging:
+            if lagging:
+                always_log('BACKEND LAGGING {0} {1:.1f}s behind'.format(self.label, lag))
+            else:
+                always_log('backend {0} caught up'.format(self.label))
+            self.lagging = lagging
+            self.update_gauge()
+
+    def update_gauge(self):
+        skipped = self.ejected_until > 0 or self.lagging
+        tile_backend_ejected.labels(self.label).set(1 if skipped else 0)
+
+    async def check(self, max_lag):
+        conn = await self.acquire()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute(backend_lag_query)
+                row = await cursor.fetchone()
+        finally:
+            await self.release(conn)
+        self.set_lag(float(row[0] or 0), max_lag)
+        if self.pool != None:
+            await pool_health_check(self.pool)
+
+class TileBackends(object):
+    def __init__(self, dsns, minsize, maxsize, eject_failures, eject_seconds, max_lag, check_timeout):
+        self.backends = [TileBackend(dsn, eject_failures, eject_seconds) for dsn in dsns]
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.max_lag = max_lag
+        self.check_timeout = check_timeout
+        for b in self.backends:
+            b.update_gauge()
+            tile_backend_outstanding.labels(b.label).set(0)
+
+    # a backend that cannot be reached at startup is ejected, not fatal,
+    # unless none can be reached at all
+    async def open(self):
+        error = None
+        for b in self.backends:
+            try:
+                await b.open(self.minsize, self.maxsize)
+            except Exception as e:
+                always_log('BACKEND OPEN FAILED {0}: {1}'.format(b.label, e))
+                tile_backend_errors.labels(b.label).inc()
+                b.eject(e)
+                error = e
+        if not any([b.usable() for b in self.backends]):
+            raise error
+
+    async def close(self):
+        for b in self.backends:
+            await b.close()
+
+    def choose(self):
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b.available(now, self.max_lag)]
+        if len(candidates) == 0:
+            # better a lagging or recovering backend than refusing every tile
+            candidates = [b for b in self.backends if b.usable()]
+        least = min([b.outstanding for b in candidates])
+        return random.choice([b for b in candidates if b.outstanding == least])
+
+    async def check_backend(self, b):
+        try:
+            await b.open(self.minsize, self.maxsize)
+            await asyncio.wait_for(b.check(self.max_lag), self.check_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            always_log('BACKEND HEALTH CHECK FAILED {0}: {1}'.format(b.label, e))
+            # a check that got no answer in time counts, a cancelled statement does not
+            if backend_failure(e) or isinstance(e, asyncio.TimeoutError):
+                b.failed(e)
+        else:
+            b.succeeded()
+
+    async def check(self):
+        await asyncio.gather(*[self.check_backend(b) for b in self.backends])
+
+class TileConnection(object):
+    def __init__(self, app, timer=None):
+        self.app = app
+        self.timer = timer
+        self.backend = None
+        self.conn = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        admission = self.app.get('admission')
+        if admission != None:
+            await admission.enter(self.timer.deadline if self.timer != None else None)
+        try:
+            self.backend = self.app['backends'].choose()
+            self.backend.begin()
+            try:
+                self.conn = await self.backend.acquire()
+            except BaseException as e:
+                self.backend.end()
+                if backend_failure(e):
+                    self.backend.failed(e)
+                raise
+        except BaseException:
+            if admission != None:
+                admission.exit()
+            raise
+        self.held = time.perf_counter()
+        if self.timer != None:
+            self.timer.phases['acquire'] = self.held - start
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.backend.release(self.conn)
+        finally:
+            self.backend.end()
+            if backend_failure(exc):
+                self.backend.failed(exc)
+            else:
+                tile_backend_time.labels(self.backend.label).sample(time.perf_counter() - self.held)
+                if exc == None:
+                    self.backend.succeeded()
+            if self.app.get('admission') != None:
+                self.app['admission'].exit()
+
+def tile_connection(app, timer=None):
+    return TileConnection(app, timer)
+
+def tile_pool_create(dsn, minsize, maxsize, statement_timeout=2000):
+    return aiopg.create_pool(dsn, minsize=minsize, maxsize=maxsize,
+        on_connect=lambda conn: tile_session_setup(conn, statement_timeout=statement_timeout))
+
+# N.B. releasing puts a connection at the back of the free queue, so
+#      acquiring freesize times visits every idle connection once.  A
+#      closed connection is dropped by the pool and replaced as needed.
+async def pool_health_check(pool):
+    for i in range(pool.freesize):
+        conn = await pool.acquire()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute('SELECT 1')
+        except Exception as e:
+            always_log('POOL HEALTH CHECK FAILED: {0}'.format(e))
+            tile_pool_unhealthy.inc()
+            conn.close()
+        finally:
+            await pool.release(conn)
+
+async def backends_health_watch(app):
+    while True:
+        await asyncio.sleep(app['pool_health_interval'])
+        await app['backends'].check()
+
+async def tile_generate(app, zoom, x, y, timer=None):
+    async with tile_connection(app, timer) as conn:
+        return await tile_handler_on_conn(conn, zoom, x, y, timer)
+
+async def tile_generate_many(app, zoom, coords, timer=None):
+    async with tile_connection(app, timer) as conn:
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            if args.assembly == 'database':
+                return await gentile_json_many_async(cursor, zoom, coords, timer)
+            return await gentile_many_async(cursor, zoom, coords, timer)
+
+def coverage_check(app, zoom, x, y):
+    coverage = app['coverage']
+    if coverage != None and not coverage.contains(x, y):
+        tile_outside.inc()
+        return False
+    return True
+
+def empty_index_check(app, zoom, x, y):
+    index = app['empty_index']
+    if index != None and zoom == zoom_default and index.contains(x, y):
+        tile_empty_hit.inc()
+        return True
+    return False
+
+def empty_index_learn(app, zoom, x, y, tile_data):
+    index = app['empty_index']
+    if index != None and zoom == zoom_default and tile_data == empty_tile_data:
+        index.add(x, y)
+
+async def tile_fetch(app, zoom, x, y, timer=None):
+    if empty_index_check(app, zoom, x, y):
+        return EncodedTile(empty_tile_data)
+    store = app['store']
+    if store != None:
+        tile = await store.read_tile_async(zoom, x, y)
+        if tile != None:
+            tile_store_hit.inc()
+            return tile
+        tile_store_miss.inc()
+    if not app['database']:
+        # archives hold every tile of their region, including empty ones
+        return EncodedTile(empty_tile_data)
+    tile_data = await tile_generate(app, zoom, x, y, timer)
+    if tile_data == None:
+        return None
+    empty_index_learn(app, zoom, x, y, tile_data)
+    if store != None:
+        await store.write_async(zoom, x, y, tile_data)
+    tile = await tile_build(tile_data)
+    tile.sample_sizes()
+    return tile
+
+async def tile_fetch_many(app, zoom, coords, timer=None):
+    store = app['store']
+    tiles = {}
+    missing = []
+    for (x, y) in coords:
+        # N.B. batches straddling the edge of coverage get empty tiles either way
+        if not coverage_check(app, zoom, x, y):
+            tiles[(x, y)] = EncodedTile(empty_tile_data)
+        elif empty_index_check(app, zoom, x, y):
+            tiles[(x, y)] = EncodedTile(empty_tile_data)
+        else:
+            missing.append((x, y))
+    if store != None:
+        coords = missing
+        missing = []
+        for (x, y) in coords:
+            tile = await store.read_tile_async(zoom, x, y)
+            if tile != None:
+                tile_store_hit.inc()
+                tiles[(x, y)] = tile
+            else:
+                tile_store_miss.inc()
+                missing.append((x, y))
+    if not app['database']:
+        for c in missing:
+            tiles[c] = EncodedTile(empty_tile_data)
+    elif len(missing) > 0:
+        generated = await tile_generate_many(app, zoom, missing, timer)
+        for ((x, y), tile_data) in generated.items():
+            empty_index_learn(app, zoom, x, y, tile_data)
+            if store != None:
+                await store.write_async(zoom, x, y, tile_data)
+            tile = await tile_build(tile_data)
+            tile.sample_sizes()
+            tiles[(x, y)] = tile
+    return tiles
+
+#
+# Overview tiles at --overview_zooms (14 and 15) cover 16 or 4 zoom 16
+# tiles and are merged from them, taken from the cache, the store or the
+# database like a batch.  Features spanning several children appear in
+# each, so they are deduplicated by osm_ids, type and value (and position
+# for intersections, as two roads can cross more than once), and kept in
+# soundscape_tile order.  Feature types in --overview_exclude are left
+# out.  Overviews are only cached, and expiring a child invalidates them.
+#
+
+def overview_key(feature):
+    key = (tuple(feature['osm_ids']), feature['feature_type'], feature['feature_value'])
+    if feature['feature_value'] == 'gd_intersection':
+        key += (tuple(feature['geometry']['coordinates']),)
+    return key
+
+# ORDER BY osm_ids, feature_type, feature_value with nulls last
+def overview_order(feature):
+    return (feature['osm_ids'],
+            feature['feature_type'] == None, feature['feature_type'] or '',
+            feature['feature_value'] == None, feature['feature_value'] or '')
+
+def overview_merge(children, exclude):
+    features = {}
+    for data in children:
+        for feature in json.loads(data)['features']:
+            if feature['feature_type'] in exclude:
+                continue
+            features.setdefault(overview_key(feature), feature)
+    return sorted(features.values(), key=overview_order)
+
+def overview_children(zoom, x, y):
+    scale = 1 << (zoom_default - zoom)
+    return [(cx, cy) for cx in range(x * scale, (x + 1) * scale) for cy in range(y * scale, (y + 1) * scale)]
+
+async def overview_fetch(app, zoom, x, y, timer=None):
+    names = dict([(tile_name(zoom_default, cx, cy), (cx, cy)) for (cx, cy) in overview_children(zoom, x, y)])
+
+    async def generate_many(keys):
+        tiles = await tile_fetch_many(app, zoom_default, [names[k] for k in keys], timer)
+        return dict([(k, tiles.get(names[k])) for k in keys])
+
+    children = await app['cache'].get_or_generate_many(list(names.keys()), generate_many)
+    if any([t == None for t in children.values()]):
+        return None
+    features = overview_merge([children[k].data for k in sorted(names.keys())], app['overview_exclude'])
+    tile_data = await tile_encode({'type': 'FeatureCollection', 'features': features}, len(features))
+    tile_overview.inc()
+    tile = await tile_build(tile_data)
+    tile.sample_sizes()
+    return tile
+
+def overview_invalidate(app, x, y):
+    for zoom in app['overview_zooms']:
+        shift = zoom_default - zoom
+        app['cache'].invalidate(tile_name(zoom, x >> shift, y >> shift))
+
+def tile_response(request, tile, content_type='application/json'):
+    encoding = tile.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding == None:
+        raise web.HTTPNotAcceptable()
+    (body, etag) = tile.representation(encoding)
+    headers = {
+        'ETag': etag,
+        'Cache-Control': request.app['cache_control'],
+        'Vary': 'Accept-Encoding',
+    }
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        tile_not_modified.inc()
+        return web.Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=body, content_type=content_type, headers=headers)
+
+#
+# Streaming mode writes features as they are fetched from the database in
+# batches of --stream_rows, so neither the rows nor the JSON of a dense
+# tile are ever held whole.  async psycopg2 has no named cursors, so the
+# server side cursor is DECLAREd in SQL inside a transaction.  Features
+# are encoded one at a time and joined exactly as tile_encoder joins a
+# whole tile, keeping the output canonical.  Tiles up to
+# --stream_cache_bytes are still cached and stored once complete.
+#
+
+stream_declare = """
+    DECLARE soundscape_tile_stream NO SCROLL CURSOR FOR SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+stream_fetch = "FETCH FORWARD {0} FROM soundscape_tile_stream"
+
+stream_prefix = b'{"features": ['
+stream_suffix = b'], "type": "FeatureCollection"}'
+
+async def tile_stream(request, zoom, x, y, timer):
+    app = request.app
+    future = app['cache'].stream_begin(tile_name(zoom, x, y))
+    try:
+        (response, features, tile_data) = await tile_stream_query(request, zoom, x, y, timer)
+    except BaseException:
+        future.set_exception(TileUncached())
+        raise
+    if tile_data == None:
+        future.set_exception(TileUncached())
+    else:
+        empty_index_learn(app, zoom, x, y, tile_data)
+        tile = await tile_build(tile_data)
+        tile.sample_sizes()
+        future.set_result(tile)
+        if app['store'] != None:
+            await app['store'].write_async(zoom, x, y, tile_data)
+    tile_streamed.inc()
+    return (response, features)
+
+async def tile_stream_query(request, zoom, x, y, timer):
+    app = request.app
+    response = None
+    kept = []
+    kept_size = 0
+    features = 0
+    complete = False
+    async with tile_connection(app, timer) as conn:
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            if timer.deadline != None:
+                await cursor.execute('BEGIN; set local statement_timeout={0}'.format(timer.remaining_ms()))
+            else:
+                await cursor.execute('BEGIN')
+            try:
+                timer.restart()
+                await cursor.execute(stream_declare, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+                timer.mark('query')
+                while True:
+                    await cursor.execute(stream_fetch.format(args.stream_rows))
+                    rows = await cursor.fetchall()
+                    timer.mark('fetch')
+                    if response == None:
+                        # N.B. once this is sent a failure can only cut the response short
+                        response = web.StreamResponse(headers={
+                            'Content-Type': 'application/json',
+                            'Cache-Control': app['cache_control'],
+                            'Vary': 'Accept-Encoding',
+                        })
+                        response.enable_compression()
+                        await response.prepare(request)
+                        await response.write(stream_prefix)
+                        timer.mark('write')
+                    if len(rows) == 0:
+                        break
+                    data = b', '.join([tile_encoder.encode(r._asdict()) for r in rows])
+                    if features > 0:
+                        data = b', ' + data
+                    features += len(rows)
+                    timer.mark('serialize')
+                    if kept != None:
+                        kept.append(data)
+                        kept_size += len(data)
+                        if kept_size > args.stream_cache_bytes:
+                            kept = None
+                    await response.write(data)
+                    timer.mark('write')
+                await response.write(stream_suffix)
+                await response.write_eof()
+                timer.mark('write')
+                complete = True
+            finally:
+                await cursor.execute('COMMIT')
+    if complete and kept != None:
+        return (response, features, stream_prefix + b''.join(kept) + stream_suffix)
+    return (response, features, None)
+
+# the response is written here, rather than by aiohttp, to time the write
+async def tile_write(request, response, timer):
+    timer.restart()
+    await response.prepare(request)
+    await response.write_eof()
+    timer.mark('write')
+    return response
+
+# only tiles that would otherwise be generated, and not by another request,
+# are streamed.  A stored tile is put in the cache for the regular path.
+# N.B. the in-flight check comes after the last await, so nothing can start
+#      generating the tile before tile_stream registers it
+async def tile_stream_wanted(app, zoom, x, y):
+    if not args.stream or not app['database']:
+        return False
+    key = tile_name(zoom, x, y)
+    if app['cache'].get(key) != None:
+        return False
+    if app['empty_index'] != None and app['empty_index'].contains(x, y):
+        return False
+    if app['store'] != None and key not in app['cache'].inflight:
+        tile = await app['store'].read_tile_async(zoom, x, y)
+        if tile != None:
+            app['cache'].put(key, tile)
+            return False
+    return key not in app['cache'].inflight
+
+# the deadline is --request_deadline from arrival, or sooner if the client
+# says it will give up sooner in X-Request-Timeout (seconds).  Only
+# --request_deadline 0 disables deadlines; header values that are not
+# positive and finite are ignored.
+def request_deadline(request):
+    timeout = args.request_deadline
+    if timeout <= 0:
+        return None
+    try:
+        client_timeout = float(request.headers['X-Request-Timeout'])
+        if client_timeout > 0 and math.isfinite(client_timeout):
+            timeout = min(timeout, client_timeout)
+    except (KeyError, ValueError):
+        pass
+    return time.monotonic() + timeout
+
+def overloaded_response():
+    return web.HTTPServiceUnavailable(headers={'Retry-After': str(args.retry_after)})
+
+async def tile_handler(request):
+    start = datetime.utcnow()
+    timer = PhaseTimer(request_deadline(request))
+    status = None
+    try:
+        zoom = int(request.match_info['zoom'])
+        if zoom != zoom_default and zoom not in request.app['overview_zooms']:
             raise web.HTTPNotFound()
         x = int(request.match_info['x'])
         y = int(request.match_info['y'])
-        tile_data = await gentile_async(cursor, zoom, x, y, True)
-        if tile_data == None:
-            logger.info('ERROR GET {0}/{1}/{2}.json'.format(zoom, x, y))
-            always_log('TILE_ERROR')
+        if not tile_in_range(zoom, x, y):
+            raise web.HTTPNotFound()
+        if zoom != zoom_default:
+            status = 'error'
+            tile = await request.app['cache'].get_or_generate(tile_name(zoom, x, y), lambda: overview_fetch(request.app, zoom, x, y, timer))
+            if tile == None:
+                log_event(logging.ERROR, 'TILE_ERROR', tile=tile_name(zoom, x, y))
+                tile_queryfail.inc()
+                raise web.HTTPServiceUnavailable()
+            tile_served.inc()
+            status = 'empty' if tile.data == empty_tile_data else 'served'
+            return await tile_write(request, tile_response(request, tile), timer)
+        if not coverage_check(request.app, zoom, x, y):
+            if request.app['outside_tile'] == None:
+                raise web.HTTPNotFound()
+            status = 'empty'
+            return await tile_write(request, tile_response(request, request.app['outside_tile']), timer)
+        status = 'error'
+        if await tile_stream_wanted(request.app, zoom, x, y):
+            (response, features) = await tile_stream(request, zoom, x, y, timer)
+            tile_served.inc()
+            status = 'served' if features > 0 else 'empty'
+            return response
+        tile = await request.app['cache'].get_or_generate(tile_name(zoom, x, y), lambda: tile_fetch(request.app, zoom, x, y, timer))
+        if tile == None:
+            log_event(logging.ERROR, 'TILE_ERROR', tile=tile_name(zoom, x, y))
             tile_queryfail.inc()
             raise web.HTTPServiceUnavailable()
         else:
             tile_served.inc()
+            status = 'empty' if tile.data == empty_tile_data else 'served'
             end = datetime.utcnow()
-            telemetry_log('request', start, end)
-            return web.Response(text=tile_data, content_type='application/json')
+            telemetry_log('request', start, end, sampled=True)
+            return await tile_write(request, tile_response(request, tile), timer)
+    except TileOverloaded:
+        status = 'shed'
+        raise overloaded_response()
+    except (psycopg2.extensions.QueryCanceledError, asyncio.TimeoutError):
+        # statement_timeout in the database or no pool connection in time
+        status = 'timeout'
+        tile_exception.inc()
+        raise
+    except Exception:
+        tile_exception.inc()
+        raise
+    finally:
+        if status != None:
+            timer.observe(status)
+
+#
+# With --mvt, /16/x/y.mvt serves the tile as a Mapbox Vector Tile built by
+# soundscape_tile_mvt from the same features, one layer per feature_type.
+# Vector tiles are cached but not stored, and the empty tile index and
+# coverage apply to them as to GeoJSON tiles; an empty vector tile has no
+# bytes at all.
+#
+
+mvt_content_type = 'application/vnd.mapbox-vector-tile'
 
-async def tile_handler_no_pooling(request):
+async def mvt_fetch(app, zoom, x, y, timer):
+    if empty_index_check(app, zoom, x, y):
+        return EncodedTile(b'')
+    if not app['database']:
+        return EncodedTile(b'')
+    async with tile_connection(app, timer) as conn:
+        async with conn.cursor() as cursor:
+            tile_data = await gentile_mvt_async(cursor, zoom, x, y, timer)
+    return await tile_build(tile_data)
+
+async def mvt_handler(request):
+    timer = PhaseTimer(request_deadline(request))
+    status = None
     try:
-        async with aiopg.connect(request.app['dsn']) as conn:
-            response = await tile_handler_on_conn(conn, request)
-            return response
+        zoom = int(request.match_info['zoom'])
+        if zoom != zoom_default:
+            raise web.HTTPNotFound()
+        x = int(request.match_info['x'])
+        y = int(request.match_info['y'])
+        if not tile_in_range(zoom, x, y):
+            raise web.HTTPNotFound()
+        if not coverage_check(request.app, zoom, x, y):
+            if request.app['outside_tile'] == None:
+                raise web.HTTPNotFound()
+            status = 'empty'
+            return await tile_write(request, tile_response(request, EncodedTile(b''), mvt_content_type), timer)
+        status = 'error'
+        tile = await request.app['cache'].get_or_generate(mvt_name(zoom, x, y), lambda: mvt_fetch(request.app, zoom, x, y, timer))
+        tile_served.inc()
+        status = 'empty' if len(tile.data) == 0 else 'served'
+        return await tile_write(request, tile_response(request, tile, mvt_content_type), timer)
+    except TileOverloaded:
+        status = 'shed'
+        raise overloaded_response()
+    except (psycopg2.extensions.QueryCanceledError, asyncio.TimeoutError):
+        status = 'timeout'
+        tile_exception.inc()
+        raise
     except Exception:
         tile_exception.inc()
         raise
+    finally:
+        if status != None:
+            timer.observe(status)
+
+#
+# /16/batch?x0=&y0=&x1=&y1= returns every tile in the inclusive range as one
+# JSON document keyed by 'zoom/x/y'.  Tiles are still cached and stored
+# individually so later single tile requests are served from the cache.
+#
 
-async def tile_handler_pooling(request):
+async def batch_handler(request):
+    start = datetime.utcnow()
     try:
-        async with request.app['pool'].acquire() as conn:
-            always_log('pool: {0}/{1}/{2}'.format(request.app['pool'].minsize, request.app['pool'].size, request.app['pool'].maxsize))
-            response = await tile_handler_on_conn(conn, request)
-            return response
+        zoom = int(request.match_info['zoom'])
+        if zoom != zoom_default:
+            raise web.HTTPNotFound()
+        try:
+            x0 = int(request.query['x0'])
+            y0 = int(request.query['y0'])
+            x1 = int(request.query['x1'])
+            y1 = int(request.query['y1'])
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest()
+        (x0, x1) = (min(x0, x1), max(x0, x1))
+        (y0, y1) = (min(y0, y1), max(y0, y1))
+        if x0 < 0 or y0 < 0 or not tile_in_range(zoom, x1, y1):
+            raise web.HTTPBadRequest(text='tiles outside zoom {0}'.format(zoom))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > request.app['batch_max']:
+            raise web.HTTPBadRequest(text='batch larger than {0} tiles'.format(request.app['batch_max']))
+        names = {}
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                names[tile_name(zoom, x, y)] = (x, y)
+
+        async def generate_many(keys):
+            tiles = await tile_fetch_many(request.app, zoom, [names[k] for k in keys], PhaseTimer(request_deadline(request)))
+            return dict([(k, tiles.get(names[k])) for k in keys])
+
+        tiles = await request.app['cache'].get_or_generate_many(list(names.keys()), generate_many)
+        if any([t == None for t in tiles.values()]):
+            log_event(logging.ERROR, 'TILE_ERROR', batch=[x0, y0, x1, y1])
+            tile_queryfail.inc()
+            raise web.HTTPServiceUnavailable()
+        keys = sorted(names.keys())
+        # N.B. the body is compressed here, once, with the validator of its encoding
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), ['br', 'gzip'] if brotli != None else ['gzip'])
+        if encoding == None:
+            raise web.HTTPNotAcceptable()
+        etag = encoding_etag('"{0}"'.format(hashlib.sha256(''.join([tiles[k].etag for k in keys]).encode('ascii')).hexdigest()[:32]), encoding)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': request.app['cache_control'],
+            'Vary': 'Accept-Encoding',
+        }
+        for k in keys:
+            tile_served.inc()
+        end = datetime.utcnow()
+        telemetry_log('batch', start, end, {'tiles': len(keys)}, sampled=True)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            tile_not_modified.inc()
+            return web.Response(status=304, headers=headers)
+        body = b'{' + b', '.join([b'"' + k[:-len('.json')].encode('ascii') + b'": ' + tiles[k].data for k in keys]) + b'}'
+        if encoding != 'identity':
+            if args.offload_bytes > 0 and len(body) >= args.offload_bytes:
+                body = await asyncio.get_event_loop().run_in_executor(offload_pool(), encoding_compress, body, encoding)
+            else:
+                body = encoding_compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, content_type='application/json', headers=headers)
+    except TileOverloaded:
+        raise overloaded_response()
     except Exception:
         tile_exception.inc()
         raise
 
-async def logger_middleware(app, handler):
-    async def logger_m(request):
-        logger.warning('REQUEST {0}'.format(request.method))
-        return await handler(request)
-    return logger_m
+async def expire_tile(app, zoom, x, y, semaphore):
+    async with semaphore:
+        stored = False
+        if app['store'] != None and app['worker'] == 0:
+            stored = await app['store'].remove_async(zoom, x, y)
+        # N.B. only once the stored tile is gone, or a request meanwhile could
+        #      cache it again, and in-flight generations may have read it
+        if app['empty_index'] != None:
+            app['empty_index'].discard(x, y)
+        app['cache'].invalidate(tile_name(zoom, x, y))
+        app['cache'].invalidate(mvt_name(zoom, x, y))
+        overview_invalidate(app, x, y)
+        # only tiles that were already in the store are worth producing again
+        if stored and app['expire_mode'] == 'regenerate':
+            try:
+                await app['cache'].get_or_generate(tile_name(zoom, x, y), lambda: tile_fetch(app, zoom, x, y))
+            except Exception as e:
+                always_log('EXPIRE REGENERATE FAILED {0}: {1}'.format(tile_name(zoom, x, y), e))
+        tile_expired.inc()
+
+async def expire_watch(app):
+    loop = asyncio.get_event_loop()
+    watcher = app['expire_watcher']
+    semaphore = asyncio.Semaphore(app['expire_concurrency'])
+    while True:
+        try:
+            lists = await loop.run_in_executor(None, watcher.scan)
+            if len(lists) > 0:
+                tiles = await loop.run_in_executor(None, watcher.read_tiles, lists)
+                tiles = [t for t in tiles if t[0] == zoom_default and tile_in_range(*t)]
+                always_log('EXPIRE {0} tiles from {1} lists'.format(len(tiles), len(lists)))
+                await asyncio.gather(*[expire_tile(app, zoom, x, y, semaphore) for (zoom, x, y) in tiles])
+                # N.B. the index in memory has forgotten these tiles, and one
+                #      saved before them replays the lists on startup, so a
+                #      failed save must not hold back the checkpoint
+                if app['empty_index'] != None:
+                    app['empty_index'].set_checkpoint(lists[-1])
+                try:
+                    empty_index_save(app)
+                except Exception as e:
+                    always_log('EMPTY INDEX SAVE FAILED: {0}'.format(e))
+                await loop.run_in_executor(None, watcher.commit, lists)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            always_log('EXPIRE FAILED: {0}'.format(e))
+        await asyncio.sleep(app['expire_interval'])
+
+def empty_index_save(app):
+    index = app['empty_index']
+    if index != None and index.dirty and app['empty_index_path'] != None:
+        index.save(app['empty_index_path'])
+
+async def empty_index_watch(app):
+    while True:
+        await asyncio.sleep(app['empty_index_interval'])
+        try:
+            empty_index_save(app)
+        except Exception as e:
+            always_log('EMPTY INDEX SAVE FAILED: {0}'.format(e))
+
+async def start_background_tasks(app):
+    if app['metrics_dir'] != None:
+        app['metrics_task'] = asyncio.ensure_future(metrics_watch(app))
+    if 'backends' in app:
+        app['backends_health_task'] = asyncio.ensure_future(backends_health_watch(app))
+    if app['expire_watcher'] != None:
+        app['expire_task'] = asyncio.ensure_future(expire_watch(app))
+    if app['empty_index'] != None:
+        app['empty_index_task'] = asyncio.ensure_future(empty_index_watch(app))
+
+async def cleanup_background_tasks(app):
+    if app['metrics_dir'] != None:
+        app['metrics_task'].cancel()
+    if 'backends' in app:
+        app['backends_health_task'].cancel()
+        await app['backends'].close()
+    if app['expire_watcher'] != None:
+        app['expire_task'].cancel()
+    if app['empty_index'] != None:
+        app['empty_index_task'].cancel()
+        try:
+            empty_index_save(app)
+        except Exception as e:
+            always_log('EMPTY INDEX SAVE FAILED: {0}'.format(e))
+
+# errors and slow requests are always logged, others at the sample rate
+@web.middleware
+async def logger_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    except asyncio.CancelledError:
+        # client went away
+        status = 499
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        level = None
+        if status >= 500:
+            level = logging.ERROR
+        elif duration >= args.slow_request:
+            level = logging.WARNING
+        elif log_sampled():
+            level = logging.INFO
+        if level != None:
+            log_event(level, 'request', method=request.method, path=request.path, status=status, duration_ms=round(duration * 1000, 3))
 
 @web.middleware
 async def error_middleware(request, handler):
@@ -196,15 +2384,72 @@ async def error_middleware(request, handler):
         raise web.HTTPInternalServerError()
 
 async def alive_handler(request):
-    always_log('ALIVE CHECK')
+    logger.debug('ALIVE CHECK')
     tilesrv_aliveprobe.inc()
     return web.Response()
 
 def metrics_to_string(m):
     return ''.join([x.report() for x in metrics])
 
+#
+# With --workers every worker writes a snapshot of its metrics to
+# metrics_dir/<pid>.json and /metrics, served by any worker, reports the
+# sum over all workers.  Snapshots of workers that died are kept as
+# retired-<pid>.json so counters and histograms do not go backwards when
+# a worker is restarted; gauges only sum live workers.
+#
+
+def metrics_snapshot_write(metrics_dir):
+    path = os.path.join(metrics_dir, '{0}.json'.format(os.getpid()))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(dict([(m.name, m.snapshot()) for m in metrics]), f)
+    os.replace(temp_path, path)
+
+def metrics_snapshots_read(metrics_dir):
+    snapshots = []
+    for name in os.listdir(metrics_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, name), 'r') as f:
+                snapshots.append((name.startswith('retired-'), json.load(f)))
+        except (FileNotFoundError, ValueError):
+            # a worker retired between listing and reading
+            continue
+    return snapshots
+
+def metrics_retire(metrics_dir, pid):
+    try:
+        os.replace(os.path.join(metrics_dir, '{0}.json'.format(pid)), os.path.join(metrics_dir, 'retired-{0}.json'.format(pid)))
+    except FileNotFoundError:
+        pass
+
+def metrics_aggregate(metrics_dir):
+    metrics_snapshot_write(metrics_dir)
+    snapshots = metrics_snapshots_read(metrics_dir)
+    aggregated = []
+    for m in metrics:
+        a = m.fresh()
+        for (retired, snapshot) in snapshots:
+            if m.name not in snapshot or (retired and not m.cumulative):
+                continue
+            a.merge(snapshot[m.name])
+        aggregated.append(a)
+    return ''.join([a.report() for a in aggregated])
+
+async def metrics_watch(app):
+    while True:
+        await asyncio.sleep(app['metrics_interval'])
+        try:
+            metrics_snapshot_write(app['metrics_dir'])
+        except Exception as e:
+            always_log('METRICS SNAPSHOT FAILED: {0}'.format(e))
+
 async def metrics_handler(request):
     tilesrv_metrics_scraped.inc()
+    if request.app['metrics_dir'] != None:
+        return web.Response(text=metrics_aggregate(request.app['metrics_dir']))
     return web.Response(text=metrics_to_string(metrics))
 
 # standard tile to coordinates and reverse versions from
@@ -233,59 +2478,797 @@ def tile_bbox_from_coords(zoom, coord_bbox):
     tile_maxy = max(ay, by)
     return (tile_minx, tile_miny, tile_maxx, tile_maxy)
 
+#
+# Log records are written as one JSON object per line.  The tile server
+# hands records to a listener thread through a queue so the event loop
+# never blocks on stdout.
+#
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        event.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return json.dumps(event, sort_keys=True, default=str)
+
+def setup_logging(queued=True):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    if queued:
+        records = SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(records))
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        root.addHandler(handler)
+    root.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+def log_event(level, message, **fields):
+    logger.log(level, message, extra={'fields': fields})
+
+def log_sampled():
+    return random.random() < args.log_sample_rate
+
 def always_log(s):
-    print('{0}: {1}'.format(datetime.now(), s))
+    logger.info(s)
 
-def telemetry_log(event_name, start, end, extra=None):
+def telemetry_log(event_name, start, end, extra=None, sampled=False):
     if args.telemetry:
+        if sampled and not log_sampled():
+            return
         if extra == None:
             extra = {}
         extra['start'] = start.isoformat()
         extra['end'] = end.isoformat()
+        extra['duration_ms'] = (end - start).total_seconds() * 1000
+        log_event(logging.INFO, 'telemetry', event=event_name, **extra)
+
+#
+# Generate each listed tile both ways and report any tile where database
+# assembly is not byte identical to python assembly.
+#
+
+async def verify_assembly_async(dsn, tiles):
+    mismatched = 0
+    async with aiopg.connect(dsn) as conn:
+        await tile_session_setup(conn, ['python', 'database'])
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            for (zoom, x, y) in tiles:
+                python_tile = await gentile_async(cursor, zoom, x, y)
+                database_tile = await gentile_json_async(cursor, zoom, x, y)
+                if python_tile == database_tile:
+                    continue
+                mismatched += 1
+                offset = next((i for i, (a, b) in enumerate(zip(python_tile, database_tile)) if a != b), min(len(python_tile), len(database_tile)))
+                always_log('MISMATCH {0} at byte {1}: python {2!r} database {3!r}'.format(tile_name(zoom, x, y), offset, python_tile[max(0, offset-40):offset+40], database_tile[max(0, offset-40):offset+40]))
+    always_log('verified {0} tiles, {1} mismatched'.format(len(tiles), mismatched))
+    return mismatched
+
+def verify_assembly(dsn, path):
+    with open(path, 'r') as f:
+        tiles = read_tile_list(f)
+    loop = asyncio.get_event_loop()
+    mismatched = loop.run_until_complete(verify_assembly_async(dsn, tiles))
+    sys.exit(1 if mismatched > 0 else 0)
+
+#
+# Tiles exercising the corners of the canonical form that real tiles only
+# hit occasionally, checked alongside any corpus of stored tiles.
+#
+
+encoder_edge_tiles = [
+    {'type': 'FeatureCollection', 'features': []},
+    {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'osm_ids': [9223372036854775807, -42], 'feature_type': 'amenity', 'feature_value': None,
+         'geometry': {'type': 'LineString', 'coordinates': [[-0.00001, 51.5], [0.000012, -0.0], [1e-07, 0.0001], [1e+16, 180.0], [-122.123456, 47]]},
+         'properties': {'name': 'Caf\u00e9 \u201cZ\u201d \U0001f600', 'note': 'tab\tnew\nline\x7f\x01 back\\slash', 'b': '', 'a': 'x:y,z'}},
+        {'type': 'Feature', 'osm_ids': [1], 'feature_type': 'highway', 'feature_value': 'primary',
+         'geometry': {'type': 'Point', 'coordinates': [1.5, 2.0]},
+         'properties': {'name': 'say "hi"', 'nested': {'z': [True, False, None], 'y': {}}}},
+    ]},
+]
+
+def load_encoder_corpus(corpus):
+    tiles = [(None, tile) for tile in encoder_edge_tiles]
+    if corpus:
+        for dirpath, dirnames, filenames in os.walk(corpus):
+            for filename in sorted(filenames):
+                if filename.endswith('.json'):
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        data = f.read()
+                    tiles.append((data, json.loads(data)))
+    return tiles
+
+def verify_encoders(corpus):
+    tiles = load_encoder_corpus(corpus)
+    reference = JsonTileEncoder()
+    mismatched = 0
+    for name, encoder_class in tile_encoders.items():
+        encoder = encoder_class()
+        for (data, obj) in tiles:
+            expected = data if data != None else reference.encode(obj)
+            if encoder.encode(obj) != expected:
+                mismatched += 1
+                always_log('MISMATCH {0}: {1!r}'.format(name, expected[:80]))
+        always_log('{0}: verified {1} tiles'.format(name, len(tiles)))
+    sys.exit(1 if mismatched > 0 else 0)
+
+def benchmark_encoders(corpus, rounds=5):
+    tiles = [obj for (data, obj) in load_encoder_corpus(corpus)]
+    for name, encoder_class in tile_encoders.items():
+        encoder = encoder_class()
+        start = time.perf_counter()
+        size = 0
+        for i in range(rounds):
+            for obj in tiles:
+                size += len(encoder.encode(obj))
+        elapsed = time.perf_counter() - start
+        always_log('{0}: {1:.1f} tiles/sec, {2:.1f} MB/sec'.format(name, rounds * len(tiles) / elapsed, size / elapsed / 1e6))
+    sys.exit(0)
+
+#
+# Bulk pre-generation of every z16 tile of an extract into a tile store.
+# Columns of tiles are sharded across worker processes, each with its own
+# connection pool.  Tiles are written as they complete, and workers append
+# each finished column to a checkpoint so an interrupted run resumes where
+# it stopped, whatever the number of processes used the next time.  Tiles
+# that failed are recorded apart from the columns and retried first by the
+# next run.
+#
+
+def load_extracts(path, names):
+    with open(path, 'r') as f:
+        extracts = json.load(f)
+    selected = [e for e in extracts if e['name'] in names]
+    missing = set(names) - set([e['name'] for e in selected])
+    if len(missing) > 0:
+        raise ValueError('unknown extracts: {0}'.format(', '.join(sorted(missing))))
+    return selected
+
+# the columns of an extract still to generate and the tiles they hold
+def region_tiles(zoom, bbox, done_columns=set()):
+    (minx, miny, maxx, maxy) = tile_bbox_from_coords(zoom, bbox)
+    columns = [x for x in range(minx, maxx + 1) if x not in done_columns]
+    return TileGen(len(columns) * (maxy - miny + 1), columns)
+
+class GenerateCheckpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.failed_path = os.path.splitext(path)[0] + '.failed'
+
+    def done_columns(self):
+        try:
+            with open(self.path, 'r') as f:
+                return set([int(line) for line in f if line.strip()])
+        except FileNotFoundError:
+            return set()
+
+    def column_done(self, x):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # single short appends are atomic so workers can share the file
+        with open(self.path, 'a') as f:
+            f.write('{0}\n'.format(x))
+
+    def failed_tiles(self):
+        try:
+            with open(self.failed_path, 'r') as f:
+                return set([tuple(map(int, line.split())) for line in f if line.strip()])
+        except FileNotFoundError:
+            return set()
+
+    def tile_failed(self, x, y):
+        os.makedirs(os.path.dirname(self.failed_path), exist_ok=True)
+        with open(self.failed_path, 'a') as f:
+            f.write('{0} {1}\n'.format(x, y))
+
+    # only called while no worker is running
+    def set_failed_tiles(self, tiles):
+        temp_path = '{0}.{1}.tmp'.format(self.failed_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            for (x, y) in sorted(tiles):
+                f.write('{0} {1}\n'.format(x, y))
+        os.replace(temp_path, self.failed_path)
+
+class ArchiveCheckpoint(object):
+    def __init__(self, db, region, lock):
+        self.db = db
+        self.region = region
+        self.lock = lock
+
+    def done_columns(self):
+        with self.lock:
+            return set([r[0] for r in self.db.execute('SELECT tile_column FROM generate_columns WHERE region=?', (self.region,)).fetchall()])
+
+    def column_done(self, x):
+        with self.lock:
+            self.db.execute('INSERT INTO generate_columns (region, tile_column) VALUES (?, ?)', (self.region, x))
+            self.db.commit()
+
+    def failed_tiles(self):
+        with self.lock:
+            return set(self.db.execute('SELECT tile_column, tile_row FROM generate_failed WHERE region=?', (self.region,)).fetchall())
+
+    def tile_failed(self, x, y):
+        with self.lock:
+            self.db.execute('INSERT INTO generate_failed (region, tile_column, tile_row) VALUES (?, ?, ?)', (self.region, x, y))
+            self.db.commit()
+
+    def set_failed_tiles(self, tiles):
+        with self.lock:
+            self.db.execute('DELETE FROM generate_failed WHERE region=?', (self.region,))
+            self.db.executemany('INSERT INTO generate_failed (region, tile_column, tile_row) VALUES (?, ?, ?)', [(self.region, x, y) for (x, y) in tiles])
+            self.db.commit()
+
+async def pregenerate_tile(pool, zoom, x, y):
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        tile_data = await tile_handler_on_conn(conn, zoom, x, y)
+    return TileResult(time.perf_counter() - start, zoom, x, y, tile_data)
+
+def pregenerate_pool_create(maxsize):
+    return tile_pool_create(args.dsn[0], maxsize, maxsize, int(args.generate_timeout * 1000))
+
+# each tile is written as soon as it is generated, so only the tiles being
+# generated are held; returns the costs and empty count of those written
+# and the tiles that failed
+async def pregenerate_tiles_async(pool, zoom, tiles, store):
+    costs = []
+    empty = []
+    failed = []
+
+    async def generate(x, y):
+        try:
+            r = await pregenerate_tile(pool, zoom, x, y)
+            await store.write_async(r.zoom, r.x, r.y, r.data)
+        except Exception as e:
+            always_log('GENERATE FAILED {0}: {1}'.format(tile_name(zoom, x, y), e))
+            failed.append((x, y))
+            return
+        costs.append(r.cost)
+        if r.data == empty_tile_data:
+            empty.append((x, y))
+
+    await asyncio.gather(*[generate(x, y) for (x, y) in tiles])
+    return (costs, len(empty), failed)
+
+async def pregenerate_shard_async(zoom, columns, miny, maxy, store, checkpoint, queue):
+    pool = await pregenerate_pool_create(args.generate_concurrency)
+    try:
+        for x in columns:
+            (costs, empty, failed) = await pregenerate_tiles_async(pool, zoom, [(x, y) for y in range(miny, maxy + 1)], store)
+            # N.B. failed tiles are recorded before the column is done with
+            for (fx, fy) in failed:
+                checkpoint.tile_failed(fx, fy)
+            checkpoint.column_done(x)
+            if len(failed) > 0:
+                queue.put(('failed', x, len(failed), 0.0, 0.0, 0))
+            if len(costs) > 0:
+                queue.put(('column', x, len(costs), sum(costs), max(costs), empty))
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+# tiles that failed in earlier runs are retried before any column
+async def pregenerate_retry_async(zoom, tiles, store):
+    pool = await pregenerate_pool_create(args.generate_concurrency)
+    try:
+        return await pregenerate_tiles_async(pool, zoom, sorted(tiles), store)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+def pregenerate_shard(zoom, columns, miny, maxy, store_root, region, queue):
+    # N.B. the listener thread of the parent does not exist after the fork
+    setup_logging(queued=False)
+    store = open_store(store_root)
+    checkpoint = store.checkpoint(region)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(pregenerate_shard_async(zoom, columns, miny, maxy, store, checkpoint, queue))
+
+def pregenerate_region(extract, store_root, processes):
+    zoom = zoom_default
+    region = extract['name']
+    store = open_store(store_root)
+    done = store.checkpoint(region).done_columns()
+    if isinstance(store, TileArchive):
+        bbox = extract['bbox']
+        store.set_metadata({
+            'name': region,
+            'format': 'application/json',
+            'compression': 'gzip',
+            'minzoom': zoom,
+            'maxzoom': zoom,
+            'bounds': '{0},{1},{2},{3}'.format(bbox[1], bbox[0], bbox[3], bbox[2]),
+            'region': region,
+            'import_timestamp': args.import_timestamp or datetime.utcnow().isoformat(),
+            'data_version': args.data_version or datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+        })
+    checkpoint = store.checkpoint(region)
+    retry = checkpoint.failed_tiles()
+    retry_failed = []
+    if len(retry) > 0:
+        (costs, empty, retry_failed) = asyncio.get_event_loop().run_until_complete(pregenerate_retry_async(zoom, retry, store))
+        checkpoint.set_failed_tiles(retry_failed)
+        always_log('{0}: retried {1} failed tiles, {2} failed again'.format(region, len(retry), len(retry_failed)))
+    # N.B. workers must open their own connections after the fork
+    store.close()
+    tiles = region_tiles(zoom, extract['bbox'], done)
+    (minx, miny, maxx, maxy) = tile_bbox_from_coords(zoom, extract['bbox'])
+    columns = tiles.generator
+    always_log('{0}: {1} tiles in {2} columns to generate, {3} columns already done'.format(region, tiles.count, len(columns), len(done)))
+
+    queue = multiprocessing.Queue()
+    workers = []
+    for shard in range(processes):
+        shard_columns = columns[shard::processes]
+        if len(shard_columns) == 0:
+            continue
+        worker = multiprocessing.Process(target=pregenerate_shard, args=(zoom, shard_columns, miny, maxy, store_root, region, queue))
+        worker.start()
+        workers.append(worker)
+
+    start = time.perf_counter()
+    generated = 0
+    empty = 0
+    cost = 0.0
+    max_cost = 0.0
+    failed = len(retry_failed)
+    while any([w.is_alive() for w in workers]) or not queue.empty():
+        try:
+            (kind, x, count, column_cost, column_max_cost, column_empty) = queue.get(timeout=1)
+        except Empty:
+            continue
+        if kind == 'failed':
+            failed += count
+            continue
+        generated += count
+        empty += column_empty
+        cost += column_cost
+        max_cost = max(max_cost, column_max_cost)
+        elapsed = time.perf_counter() - start
+        always_log('{0}: {1}/{2} tiles, {3:.1f} tiles/sec, {4} empty, cost mean {5:.1f}ms max {6:.1f}ms'.format(
+            region, generated, tiles.count, generated / elapsed, empty, 1000 * cost / generated, 1000 * max_cost))
+    failed_workers = 0
+    for w in workers:
+        w.join()
+        if w.exitcode != 0:
+            failed_workers += 1
+    if failed > 0 or failed_workers > 0:
+        always_log('{0}: {1} tiles and {2} workers failed, rerun to resume'.format(region, failed, failed_workers))
+    return failed == 0 and failed_workers == 0
+
+def pregenerate(names):
+    if not args.store:
+        raise ValueError('--generate needs --store')
+    ok = True
+    for extract in load_extracts(args.extracts, names):
+        ok = pregenerate_region(extract, args.store, args.processes) and ok
+    sys.exit(0 if ok else 1)
+
+#
+# Expire daemon: keeps a pre-generated store or archive current by
+# regenerating exactly the tiles in each new imposm expire list, at most
+# --expire_concurrency at a time.  Lists are only checkpointed once all
+# their tiles were written, so a failed pass is retried as a whole.
+#
+
+async def expire_regenerate(pool, store, zoom, x, y):
+    r = await pregenerate_tile(pool, zoom, x, y)
+    return await store.write_async(zoom, x, y, r.data)
+
+async def expire_daemon_async(store, watcher):
+    loop = asyncio.get_event_loop()
+    pool = await tile_pool_create(args.dsn[0], 0, args.expire_concurrency, int(args.generate_timeout * 1000))
+    try:
+        while True:
+            lists = await loop.run_in_executor(None, watcher.scan)
+            if len(lists) > 0:
+                start = time.perf_counter()
+                tiles = await loop.run_in_executor(None, watcher.read_tiles, lists)
+                tiles = sorted([t for t in tiles if t[0] == zoom_default])
+                results = await asyncio.gather(*[expire_regenerate(pool, store, zoom, x, y) for (zoom, x, y) in tiles], return_exceptions=True)
+                failed = [e for e in results if isinstance(e, Exception)]
+                changed = len([r for r in results if r is True])
+                always_log('EXPIRE {0} tiles from {1} lists regenerated in {2:.1f}s, {3} changed, {4} failed'.format(
+                    len(tiles), len(lists), time.perf_counter() - start, changed, len(failed)))
+                if len(failed) > 0:
+                    always_log('EXPIRE FAILED: {0}'.format(failed[0]))
+                else:
+                    await loop.run_in_executor(None, watcher.commit, lists)
+            await asyncio.sleep(args.expire_interval)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+def expire_daemon():
+    if not args.store or not args.expiredir:
+        raise ValueError('--expire_daemon needs --store and --expiredir')
+    store = open_store(args.store)
+    watcher = ExpireWatcher(args.expiredir, expire_checkpoint_path(args.store))
+    always_log('expire daemon watching {0} for {1}'.format(args.expiredir, args.store))
+    asyncio.get_event_loop().run_until_complete(expire_daemon_async(store, watcher))
+
+#
+# Static publishing of the store for serving through a CDN.  The manifest
+# of what was published, name to hash, lives alongside the tiles at the
+# destination and is written last, so only tiles whose hash differs from
+# the previous run are uploaded and an interrupted run is simply redone.
+#
+
+published_manifest_name = 'manifest.json.gz'
+
+class FileBackend(object):
+    def __init__(self, root):
+        self.root = root
+
+    async def get(self, name):
+        try:
+            with open(os.path.join(self.root, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    async def delete(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+    async def close(self):
+        pass
+
+# N.B. plain unsigned PUT/GET/DELETE of objects under a container or bucket
+#      URL, so the URL itself must grant writes: Azure blob storage with a
+#      SAS token in the query string, or a bucket open to anonymous writes.
+#      S3 and MinIO buckets normally need SigV4 signed requests, which this
+#      does not do.  Tiles are uploaded gzip compressed as a CDN would serve
+#      them.
+class HttpBackend(object):
+    def __init__(self, url):
+        (self.base, _, self.query) = url.partition('?')
+        self.base = self.base.rstrip('/')
+        self.session = aiohttp.ClientSession()
+
+    def url(self, name):
+        if self.query:
+            return '{0}/{1}?{2}'.format(self.base, name, self.query)
+        return '{0}/{1}'.format(self.base, name)
+
+    async def get(self, name):
+        async with self.session.get(self.url(name)) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            return await response.read()
+
+    async def put(self, name, data):
+        headers = {'x-ms-blob-type': 'BlockBlob'}
+        if name.endswith('.json'):
+            data = gzip.compress(data, compresslevel=9)
+            headers['Content-Type'] = 'application/json'
+            headers['Content-Encoding'] = 'gzip'
+        async with self.session.put(self.url(name), data=data, headers=headers) as response:
+            response.raise_for_status()
+
+    async def delete(self, name):
+        async with self.session.delete(self.url(name)) as response:
+            if response.status != 404:
+                response.raise_for_status()
+
+    async def close(self):
+        await self.session.close()
+
+def open_backend(destination):
+    if destination.startswith('http://') or destination.startswith('https://'):
+        return HttpBackend(destination)
+    return FileBackend(destination)
+
+async def publish_tile(store, backend, name, semaphore):
+    async with semaphore:
+        (zoom, x, y) = tile_coords(name)
+        data = await store.read_async(zoom, x, y)
+        if data == None:
+            raise ValueError('{0} is in the manifest but not the store'.format(name))
+        await backend.put(name, data)
+
+async def publish_async(store, backend):
+    start = time.perf_counter()
+    current = store.manifest.hashes()
+    published = await backend.get(published_manifest_name)
+    if published != None:
+        published = json.loads(gzip.decompress(published))
+    else:
+        published = {}
+    changed = sorted([name for name, digest in current.items() if published.get(name) != digest])
+    removed = sorted([name for name in published if name not in current])
+    cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(args.publish_concurrency)
+    await asyncio.gather(*[publish_tile(store, backend, name, semaphore) for name in changed])
+    await asyncio.gather(*[backend.delete(name) for name in removed])
+    await backend.put(published_manifest_name, gzip.compress(json.dumps(current, sort_keys=True).encode()))
+    upload_cost = time.perf_counter() - start
+    return (TileCloudStat(len(current), len(changed), cost, upload_cost), len(removed))
+
+def publish(destination):
+    if not args.store:
+        raise ValueError('--publish needs --store')
+    store = open_store(args.store)
+    loop = asyncio.get_event_loop()
+    backend = open_backend(destination)
+    try:
+        (stat, removed) = loop.run_until_complete(publish_async(store, backend))
+    finally:
+        loop.run_until_complete(backend.close())
+    always_log('published {0}: {1} tiles, {2} uploaded, {3} removed, diff {4:.1f}s, upload {5:.1f}s'.format(
+        destination, stat.generated, stat.uploaded, removed, stat.cost, stat.upload_cost))
+    sys.exit(0)
 
 async def app_factory():
     app = web.Application()
-    if args.verbose:
-        app.middlewares.append(logger_middleware)
+    app.middlewares.append(logger_middleware)
     app.middlewares.append(error_middleware)
-    app['dsn'] = args.dsn
-    if connection_pooling:
-        app['pool'] = await aiopg.create_pool(app['dsn'], minsize=0, pool_recycle=30*60)
+    app['worker'] = worker_index
+    app['metrics_dir'] = args.metrics_dir
+    app['metrics_interval'] = args.metrics_interval
+    app['cache'] = TileCache(args.cache_bytes, args.cache_ttl)
+    app['cache_control'] = 'public, max-age={0}'.format(args.max_age)
+    if args.stale_while_revalidate > 0:
+        app['cache_control'] += ', stale-while-revalidate={0}'.format(args.stale_while_revalidate)
+    # serving from a read only archive needs no database at all
+    app['database'] = not args.archive
+    if app['database']:
+        app['backends'] = TileBackends(args.dsn, args.pool_min, args.pool_max, args.eject_failures, args.eject_seconds, args.max_lag, args.pool_health_interval)
+        await app['backends'].open()
+        app['pool_health_interval'] = args.pool_health_interval
+        app['admission'] = TileAdmission(args.admit_limit or args.pool_max * len(args.dsn), args.admit_queue, args.min_query_time)
+    app['batch_max'] = args.batch_max
+    app['overview_zooms'] = args.overview_zooms
+    app['overview_exclude'] = set(args.overview_exclude)
+
+    app['store'] = None
+    if args.archive:
+        app['store'] = TileArchive(args.archive, readonly=True, mmap_size=args.archive_mmap)
+        always_log('serving archive {0}'.format(app['store'].metadata()))
+    elif args.store:
+        app['store'] = open_store(args.store)
+
+    app['coverage'] = None
+    if args.where:
+        extracts = load_extracts(args.extracts, args.where)
+        app['coverage'] = TileCoverage(zoom_default, [e['bbox'] for e in extracts])
+        always_log('serving regions {0}: {1}'.format(', '.join(args.where), app['coverage'].ranges))
+    app['outside_tile'] = None
+    if args.outside == 'empty':
+        app['outside_tile'] = EncodedTile(empty_tile_data)
+
+    app['empty_index'] = None
+    if args.empty_index:
+        if os.path.exists(args.empty_index):
+            app['empty_index'] = EmptyTileIndex.load(args.empty_index)
+        else:
+            app['empty_index'] = EmptyTileIndex()
+            # seed from the store, e.g. after --generate, by the empty tile hash
+            if app['store'] != None and app['database']:
+                empty_hash = hashlib.sha256(empty_tile_data).hexdigest()
+                for (name, digest) in app['store'].manifest.hashes().items():
+                    (zoom, x, y) = tile_coords(name)
+                    if digest == empty_hash and zoom == zoom_default:
+                        app['empty_index'].add(x, y)
+                # the store is as recent as the lists it has consumed
+                if args.expiredir:
+                    app['empty_index'].checkpoint = ExpireWatcher(args.expiredir, expire_checkpoint_path(args.store)).last or None
+        if args.expiredir and app['database']:
+            lists = empty_index_replay(app['empty_index'], args.expiredir)
+            if len(lists) > 0:
+                always_log('empty tile index replayed {0} expire lists'.format(len(lists)))
+        app['empty_index'].update_gauges()
+        # N.B. other workers learn and forget tiles too but only the first saves
+        app['empty_index_path'] = args.empty_index if worker_index == 0 else None
+        app['empty_index_interval'] = args.empty_index_interval
+        always_log('empty tile index of {0} tiles'.format(app['empty_index'].count))
+
+    app['expire_watcher'] = None
+    if args.expiredir and not args.archive:
+        # N.B. without a store only the in-memory cache needs expiring, and
+        #      lists written before start up cannot refer to cached tiles.
+        #      With --workers every worker expires its own cache but only
+        #      the first removes tiles from the store and checkpoints.
+        if app['store'] != None and worker_index == 0:
+            checkpoint = expire_checkpoint_path(args.store)
+        else:
+            checkpoint = None
+        app['expire_watcher'] = ExpireWatcher(args.expiredir, checkpoint)
+        if checkpoint == None:
+            app['expire_watcher'].commit(app['expire_watcher'].scan())
+        app['expire_mode'] = args.expire_mode
+        app['expire_interval'] = args.expire_interval
+        app['expire_concurrency'] = args.expire_concurrency
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(cleanup_background_tasks)
 
     # assume ingress addding /tiles/
     app.add_routes([web.get(r'/{zoom:\d+}/{x:\d+}/{y:\d+}.json', tile_handler),
+                    web.get(r'/{zoom:\d+}/batch', batch_handler),
                     web.get('/probe/alive', alive_handler),
                     web.get('/metrics', metrics_handler)])
+    if args.mvt:
+        app.add_routes([web.get(r'/{zoom:\d+}/{x:\d+}/{y:\d+}.mvt', mvt_handler)])
     return app
 
+#
+# --workers N forks N event loop processes sharing the port through
+# SO_REUSEPORT, each with its own pool and cache.  The supervisor only
+# restarts workers that exit.
+#
+
+worker_index = 0
+
+def serve_worker(index):
+    global worker_index
+    worker_index = index
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # N.B. the listener thread of the supervisor does not exist after the fork
+    setup_logging()
+    web.run_app(app_factory(), reuse_port=True, access_log=None, print=None)
+
+def supervise_workers(count):
+    if args.metrics_dir == None:
+        args.metrics_dir = tempfile.mkdtemp(prefix='gentiles-metrics-')
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    workers = {}
+    def start(index):
+        worker = multiprocessing.Process(target=serve_worker, args=(index,))
+        worker.start()
+        workers[index] = worker
+        always_log('worker {0} started as pid {1}'.format(index, worker.pid))
+
+    for index in range(count):
+        start(index)
+    while len(stopping) == 0:
+        time.sleep(1)
+        for (index, worker) in list(workers.items()):
+            if not worker.is_alive() and len(stopping) == 0:
+                always_log('worker {0} pid {1} exited with {2}, restarting'.format(index, worker.pid, worker.exitcode))
+                metrics_retire(args.metrics_dir, worker.pid)
+                start(index)
+    for worker in workers.values():
+        worker.terminate()
+    for worker in workers.values():
+        worker.join()
+    sys.exit(0)
+
 def main():
     global args
     global logger
     global tc
-    global tile_handler
+    global tile_encoder
 
     parser = argparse.ArgumentParser(description='tile generator for Soundscape')
     parser.add_argument('--server', nargs=1, type=int, default=8080, help='server port')
-    parser.add_argument('--dsn', type=str, help='specify dsn', default='dbname=osm')
+    parser.add_argument('--dsn', type=str, nargs='+', help='specify dsn, tile queries are spread over several, the first is the primary used by offline modes', default=['dbname=osm'])
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose')
     parser.add_argument('--telemetry', action='store_true', help='enable telemetry')
+    parser.add_argument('--stream', action='store_true', help='stream generated tiles from a server side cursor')
+    parser.add_argument('--stream_rows', type=int, default=200, help='features fetched per batch when streaming')
+    parser.add_argument('--stream_cache_bytes', type=int, default=1024 * 1024, help='streamed tiles up to this size are cached and stored')
+    parser.add_argument('--offload_rows', type=int, default=1000, help='tiles of at least this many features are serialized off the event loop, 0 never')
+    parser.add_argument('--offload_bytes', type=int, default=64 * 1024, help='tiles of at least this many bytes are hashed and compressed off the event loop, 0 never')
+    parser.add_argument('--offload_workers', type=int, default=2, help='size of the serialization offload pool')
+    parser.add_argument('--offload_executor', type=str, choices=['process', 'thread'], default='process', help='kind of serialization offload pool')
+    parser.add_argument('--workers', type=int, default=1, help='server processes sharing the port')
+    parser.add_argument('--metrics_dir', type=str, help='directory where workers share metrics, a temporary directory by default')
+    parser.add_argument('--metrics_interval', type=int, default=5, help='seconds between metrics snapshots of each worker')
+    parser.add_argument('--latency_buckets', type=float, nargs=3, metavar=('START', 'FACTOR', 'COUNT'), default=[0.0005, 2, 16], help='exponential buckets of latency histograms')
+    parser.add_argument('--log_sample_rate', type=float, default=0.01, help='fraction of requests logged, errors and slow requests are always logged')
+    parser.add_argument('--slow_request', type=float, default=1.0, help='seconds after which a request is logged as slow')
+    parser.add_argument('--cache_bytes', type=int, default=64 * 1024 * 1024, help='tile cache budget in bytes, 0 disables caching')
+    parser.add_argument('--cache_ttl', type=int, default=10 * 60, help='seconds a cached tile stays valid')
+    parser.add_argument('--assembly', type=str, choices=['python', 'database'], default='python', help='where tile GeoJSON is assembled and serialized')
+    parser.add_argument('--mvt', action='store_true', help='also serve Mapbox Vector Tiles at /16/x/y.mvt, needs soundscape_tile_mvt')
+    parser.add_argument('--verify_assembly', type=str, metavar='TILES', help='compare python and database assembly for the zoom/x/y tiles listed in a file and exit')
+    parser.add_argument('--encoder', type=str, choices=['auto', 'json', 'orjson'], default='auto', help='tile serializer, auto uses orjson when installed')
+    parser.add_argument('--verify_encoders', type=str, nargs='?', const='', metavar='CORPUS', help='check every encoder reproduces the tiles in a tile store directory byte for byte and exit')
+    parser.add_argument('--benchmark_encoders', type=str, nargs='?', const='', metavar='CORPUS', help='report tiles/sec of every encoder over a tile store directory and exit')
+    parser.add_argument('--generate', metavar='region', nargs='+', type=str, help='pre-generate every tile of the named extracts into --store and exit')
+    parser.add_argument('--extracts', type=str, default='extracts.json', help='extracts file')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes used by --generate')
+    parser.add_argument('--generate_concurrency', type=int, default=4, help='database connections per --generate worker')
+    parser.add_argument('--generate_timeout', type=float, default=60, help='statement timeout in seconds of a tile generated by --generate or --expire_daemon')
+    parser.add_argument('--batch_max', type=int, default=25, help='most tiles returned by one batch request')
+    parser.add_argument('--overview_zooms', type=int, nargs='*', choices=[14, 15], default=[14, 15], help='zooms served as overviews merged from zoom 16 tiles')
+    parser.add_argument('--overview_exclude', type=str, nargs='*', default=[], help='feature types left out of overview tiles')
+    parser.add_argument('--max_age', type=int, default=5 * 60, help='Cache-Control max-age of tile responses in seconds')
+    parser.add_argument('--stale_while_revalidate', type=int, default=60 * 60, help='Cache-Control stale-while-revalidate of tile responses in seconds, 0 omits it')
+    parser.add_argument('--store', type=str, help='directory, or .mbtiles archive, of pre-rendered tiles to serve from and add to')
+    parser.add_argument('--archive', type=str, help='serve only from a read only .mbtiles archive, without a database')
+    parser.add_argument('--archive_mmap', type=int, default=1024 * 1024 * 1024, help='bytes of the archive to mmap')
+    parser.add_argument('--import_timestamp', type=str, help='import timestamp recorded in generated archives')
+    parser.add_argument('--data_version', type=str, help='data version recorded in generated archives')
+    parser.add_argument('--pool_min', type=int, default=2, help='database connections opened at startup and kept open')
+    parser.add_argument('--pool_max', type=int, default=10, help='maximum database connections')
+    parser.add_argument('--pool_health_interval', type=int, default=30, help='seconds between health checks of idle database connections')
+    parser.add_argument('--search_path', type=str, default='public', help='search_path of database connections')
+    parser.add_argument('--eject_failures', type=int, default=3, help='connection failures in a row before a backend is ejected')
+    parser.add_argument('--eject_seconds', type=int, default=30, help='seconds an ejected backend receives no tile queries')
+    parser.add_argument('--max_lag', type=float, default=30.0, help='seconds of replication lag beyond which a replica is skipped')
+    parser.add_argument('--admit_limit', type=int, help='tile generations running at once, --pool_max for each --dsn by default')
+    parser.add_argument('--admit_queue', type=int, default=100, help='tile generations waiting for admission before requests are shed')
+    parser.add_argument('--request_deadline', type=float, default=2.0, help='seconds a tile request may take, also its statement timeout, 0 for none')
+    parser.add_argument('--min_query_time', type=float, default=0.05, help='requests with less time than this left are shed instead of queued')
+    parser.add_argument('--retry_after', type=int, default=1, help='Retry-After seconds of shed requests')
+    parser.add_argument('--where', metavar='region', nargs='+', type=str, help='extracts served, tiles outside them are not queried')
+    parser.add_argument('--outside', type=str, choices=['empty', '404'], default='empty', help='response for tiles outside the served extracts')
+    parser.add_argument('--empty_index', type=str, help='file of tiles known to be empty, learned as tiles are generated')
+    parser.add_argument('--empty_index_interval', type=int, default=300, help='seconds between saves of the empty tile index')
+    parser.add_argument('--expiredir', type=str, help='imposm expired tiles directory to watch')
+    parser.add_argument('--expire_mode', type=str, choices=['delete', 'regenerate'], default='delete', help='what to do with expired tiles in the store')
+    parser.add_argument('--expire_interval', type=int, default=30, help='seconds between scans of the expired tiles directory')
+    parser.add_argument('--expire_concurrency', type=int, default=4, help='expired tiles regenerated concurrently')
+    parser.add_argument('--expire_daemon', action='store_true', help='regenerate expired tiles into --store instead of serving tiles')
+    parser.add_argument('--publish', type=str, help='upload tiles of --store changed since the last publish to a directory or container/bucket URL')
+    parser.add_argument('--publish_concurrency', type=int, default=16, help='tiles uploaded concurrently')
 
     args = parser.parse_args()
 
-    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s')
-    logger = logging.getLogger()
-    if args.telemetry:
-        pass
+    setup_logging()
+    logger = logging.getLogger('gentiles')
+
+    (bucket_start, bucket_factor, bucket_count) = args.latency_buckets
+    for h in [tile_querytime, tile_pool_acquire, tile_phase, tile_offload_time, tile_backend_time]:
+        h.set_bounds(exponential_buckets(bucket_start, bucket_factor, int(bucket_count)))
+
+    if args.encoder == 'auto':
+        args.encoder = 'orjson' if 'orjson' in tile_encoders else 'json'
+    if args.encoder not in tile_encoders:
+        parser.error('encoder {0} is not installed'.format(args.encoder))
+    tile_encoder = tile_encoders[args.encoder]()
+
+    if args.verify_encoders != None:
+        verify_encoders(args.verify_encoders)
+    if args.benchmark_encoders != None:
+        benchmark_encoders(args.benchmark_encoders)
+    if args.verify_assembly:
+        verify_assembly(args.dsn[0], args.verify_assembly)
+    if args.generate:
+        pregenerate(args.generate)
+    if args.expire_daemon:
+        expire_daemon()
+    if args.publish:
+        publish(args.publish)
 
     always_log('start server')
     tilesrv_start.inc()
 
-    if connection_pooling:
-        tile_handler = tile_handler_pooling
-    else:
-        tile_handler = tile_handler_no_pooling
+    if args.workers > 1:
+        supervise_workers(args.workers)
 
-    web.run_app(app_factory())
+    # N.B. requests are logged, sampled, by logger_middleware
+    web.run_app(app_factory(), access_log=None)
 
 if __name__ == '__main__':
     main()
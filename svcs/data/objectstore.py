@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Local stand-in for the container or bucket gentiles.py --publish writes
+# to, for trying a publish without a cloud account.  Objects are PUT, GET
+# and DELETEd by name under the root URL and kept in memory, with the
+# Content-Type and Content-Encoding they were PUT with, so a second
+# publish shows exactly which tiles were uploaded again.  With --sas the
+# query string must carry that token, as with an Azure SAS URL; requests
+# are otherwise unsigned.  /_stats reports objects, bytes and requests by
+# method.
+#
+
+import gzip
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+kept_headers = ['Content-Type', 'Content-Encoding']
+
+async def object_handler(request):
+    app = request.app
+    if app['sas'] != None and request.query_string != app['sas']:
+        raise web.HTTPForbidden()
+    name = request.match_info['name']
+    app['requests'][request.method] += 1
+    if request.method == 'PUT':
+        body = await request.read()
+        headers = dict([(h, request.headers[h]) for h in kept_headers if h in request.headers])
+        # N.B. aiohttp decodes request bodies, so gzip ones are compressed again
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.compress(body)
+        app['objects'][name] = (body, headers)
+        return web.Response(status=201)
+    if name not in app['objects']:
+        raise web.HTTPNotFound()
+    if request.method == 'DELETE':
+        del app['objects'][name]
+        return web.Response(status=202)
+    (body, headers) = app['objects'][name]
+    return web.Response(body=body, headers=headers)
+
+async def stats_handler(request):
+    app = request.app
+    return web.json_response({
+        'objects': len(app['objects']),
+        'bytes': sum([len(body) for (body, headers) in app['objects'].values()]),
+        'requests': dict(app['requests']),
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description='local object store stand-in for gentiles.py --publish')
+    parser.add_argument('--port', type=int, default=9000, help='port to listen on')
+    parser.add_argument('--sas', type=str, help='query string every request must carry, e.g. sv=2020-08-04&sig=local')
+    args = parser.parse_args()
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app['objects'] = {}
+    app['requests'] = Counter()
+    app['sas'] = args.sas
+    app.router.add_get('/_stats', stats_handler)
+    for method in ['PUT', 'GET', 'DELETE']:
+        app.router.add_route(method, '/{name:.+}', object_handler)
+    web.run_app(app, port=args.port)
+
+if __name__ == '__main__':
+    main()
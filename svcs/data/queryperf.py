@@ -0,0 +1,307 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Profiler of soundscape_tile().  A function call is a single opaque node
+# to EXPLAIN, so the body of the function is read from pg_proc, its
+# parameters replaced by the tile being profiled, and the query run under
+# EXPLAIN (ANALYZE, BUFFERS).  Time and buffers of every plan node are
+# attributed to the part of the query it belongs to: a CTE (roads,
+# places), a branch of the UNION (places, roads, intersections, entrance
+# lists) or the outer projection and sort.  Tiles are sampled from the
+# features of a region, so dense tiles are sampled the most.
+#
+
+import sys
+import math
+import json
+import re
+import argparse
+from collections import OrderedDict
+
+import psycopg2
+
+function_source_query = "SELECT prosrc FROM pg_proc WHERE proname = %(name)s"
+
+# N.B. sampling features rather than tiles weights tiles by their density
+sample_query = """
+    SELECT ST_Y(ST_PointOnSurface(geometry)), ST_X(ST_PointOnSurface(geometry))
+      FROM {0} TABLESAMPLE SYSTEM (%(percent)s) REPEATABLE (%(seed)s)
+     WHERE geometry && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s, 4326)
+     LIMIT %(limit)s
+"""
+
+sample_tables = ['osm_places', 'osm_roads']
+
+# the branches of the UNION in soundscape_tile, in order
+union_branches = ['union places', 'union roads', 'union intersections', 'union entrance lists']
+
+buffer_keys = ['Shared Hit Blocks', 'Shared Read Blocks', 'Temp Read Blocks', 'Temp Written Blocks']
+
+def osm_deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (xtile, ytile)
+
+def load_extracts(path, names):
+    with open(path, 'r') as f:
+        extracts = json.load(f)
+    selected = [e for e in extracts if e['name'] in names]
+    missing = set(names) - set([e['name'] for e in selected])
+    if len(missing) > 0:
+        raise ValueError('unknown extracts: {0}'.format(', '.join(sorted(missing))))
+    return selected
+
+def read_tile_list(f):
+    tiles = []
+    for line in f:
+        line = line.strip()
+        if line == '':
+            continue
+        (zoom, x, y) = line.split('/')
+        tiles.append((int(zoom), int(x), int(y)))
+    return tiles
+
+def sample_tiles(cursor, extracts, zoom, count, percent, seed):
+    tiles = OrderedDict()
+    for extract in extracts:
+        (south, west, north, east) = extract['bbox']
+        for table in sample_tables:
+            cursor.execute(sample_query.format(table), {
+                'percent': percent, 'seed': seed, 'limit': count,
+                'west': west, 'south': south, 'east': east, 'north': north,
+            })
+            for (lat, lon) in cursor.fetchall():
+                (x, y) = osm_deg2num(lat, lon, zoom)
+                tiles[(zoom, x, y)] = True
+    return list(tiles.keys())[:count]
+
+def tile_query(source, zoom, x, y):
+    for (name, value) in [('zoom', zoom), ('tile_x', x), ('tile_y', y)]:
+        source = re.sub(r'\b{0}\b'.format(name), str(int(value)), source)
+    return source
+
+#
+# Attribution.  A node's own time is its total time less that of its
+# children.  CTEs are the exception: a CTE runs when its CTE Scans first
+# read it, so its time is inside theirs as well as in its own subplan.
+# The CTE subplan keeps its time, and only what the scans of a CTE spent
+# beyond it is left to them, shared in proportion.
+#
+
+class PlanNode(object):
+    def __init__(self, plan, section):
+        self.plan = plan
+        self.section = section
+        loops = plan.get('Actual Loops', 0)
+        self.total = plan.get('Actual Total Time', 0.0) * loops
+        self.buffers = dict([(key, plan.get(key, 0)) for key in buffer_keys])
+        self.own = self.total
+        self.own_buffers = dict(self.buffers)
+
+    def label(self):
+        plan = self.plan
+        target = plan.get('Relation Name') or plan.get('CTE Name') or plan.get('Function Name')
+        if target != None:
+            return '{0} on {1}'.format(plan['Node Type'], target)
+        return plan['Node Type']
+
+def is_cte(plan):
+    return plan.get('Subplan Name', '').startswith('CTE ')
+
+def plan_nodes(plan, section='outer', nodes=None, union_seen=None):
+    if nodes == None:
+        nodes = []
+    if union_seen == None:
+        union_seen = [False]
+    if plan.get('Subplan Name') != None:
+        section = plan['Subplan Name']
+    node = PlanNode(plan, section)
+    nodes.append(node)
+    children = plan.get('Plans', [])
+    branches = None
+    if plan['Node Type'] == 'Append' and section == 'outer' and not union_seen[0]:
+        union_seen[0] = True
+        branches = [c for c in children if c.get('Parent Relationship') == 'Member']
+    for child in children:
+        child_section = section
+        if branches != None and child in branches:
+            index = branches.index(child)
+            if len(branches) == len(union_branches):
+                child_section = union_branches[index]
+            else:
+                child_section = 'union {0}'.format(index + 1)
+        child_node = plan_nodes(child, child_section, nodes, union_seen)
+        if not is_cte(child):
+            node.own -= child_node.total
+            for key in buffer_keys:
+                node.own_buffers[key] -= child_node.buffers[key]
+    return node
+
+def attribute(plan):
+    nodes = []
+    plan_nodes(plan, nodes=nodes)
+    ctes = dict([(n.plan['Subplan Name'][len('CTE '):], n) for n in nodes if is_cte(n.plan)])
+    for (name, cte) in ctes.items():
+        scans = [n for n in nodes if n.plan['Node Type'] == 'CTE Scan' and n.plan.get('CTE Name') == name]
+        scanned = sum([n.total for n in scans])
+        for scan in scans:
+            share = scan.total / scanned if scanned > 0 else 0.0
+            scan.own = max(scan.total - cte.total * share, 0.0)
+            for key in buffer_keys:
+                scan.own_buffers[key] = max(scan.buffers[key] - cte.buffers[key] * share, 0)
+    for n in nodes:
+        n.own = max(n.own, 0.0)
+        for key in buffer_keys:
+            n.own_buffers[key] = max(n.own_buffers[key], 0)
+    return nodes
+
+#
+# Profiling
+#
+
+class Hotspots(object):
+    def __init__(self):
+        self.sections = OrderedDict()
+        self.nodes = OrderedDict()
+
+    def add(self, table, key, node):
+        entry = table.get(key)
+        if entry == None:
+            entry = dict([('ms', 0.0)] + [(k, 0) for k in buffer_keys])
+            table[key] = entry
+        entry['ms'] += node.own
+        for k in buffer_keys:
+            entry[k] += node.own_buffers[k]
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            self.add(self.sections, node.section, node)
+            self.add(self.nodes, '{0}: {1}'.format(node.section, node.label()), node)
+
+def ranked(table, total):
+    entries = []
+    for (key, entry) in sorted(table.items(), key=lambda e: -e[1]['ms']):
+        entry = dict(entry)
+        entry['name'] = key
+        entry['ms'] = round(entry['ms'], 3)
+        for k in buffer_keys:
+            entry[k] = int(round(entry[k]))
+        entry['share'] = round(entry['ms'] / total, 4) if total > 0 else None
+        entries.append(entry)
+    return entries
+
+def profile_tile(cursor, source, zoom, x, y, warmup):
+    query = tile_query(source, zoom, x, y)
+    for i in range(warmup):
+        cursor.execute(query)
+        cursor.fetchall()
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query)
+    explained = cursor.fetchone()[0]
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+    return explained[0]
+
+def profile(args):
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    if args.statement_timeout > 0:
+        cursor.execute('set statement_timeout={0}'.format(args.statement_timeout))
+    cursor.execute(function_source_query, {'name': args.function})
+    row = cursor.fetchone()
+    if row == None:
+        raise ValueError('function {0} not found'.format(args.function))
+    source = row[0]
+
+    if args.tiles:
+        with open(args.tiles, 'r') as f:
+            tiles = read_tile_list(f)[:args.sample]
+    else:
+        extracts = load_extracts(args.extracts, args.where)
+        tiles = sample_tiles(cursor, extracts, args.zoom, args.sample, args.sample_percent, args.seed)
+
+    hotspots = Hotspots()
+    results = []
+    for (zoom, x, y) in tiles:
+        try:
+            explained = profile_tile(cursor, source, zoom, x, y, args.warmup)
+        except psycopg2.Error as e:
+            print('{0}/{1}/{2}: {3}'.format(zoom, x, y, str(e).strip()), file=sys.stderr)
+            continue
+        nodes = attribute(explained['Plan'])
+        hotspots.add_nodes(nodes)
+        sections = {}
+        for node in nodes:
+            sections[node.section] = sections.get(node.section, 0.0) + node.own
+        results.append({
+            'tile': '{0}/{1}/{2}'.format(zoom, x, y),
+            'execution_ms': round(explained['Execution Time'], 3),
+            'planning_ms': round(explained['Planning Time'], 3),
+            'features': explained['Plan'].get('Actual Rows', 0),
+            'shared_read_blocks': explained['Plan'].get('Shared Read Blocks', 0),
+            'dominant': max(sections.items(), key=lambda s: s[1])[0],
+            'sections_ms': dict([(k, round(v, 3)) for (k, v) in sections.items()]),
+        })
+    conn.close()
+
+    total = sum([e['ms'] for e in hotspots.sections.values()])
+    executions = sorted([r['execution_ms'] for r in results])
+    return {
+        'function': args.function,
+        'tiles': len(results),
+        'execution_ms': {
+            'total': round(sum(executions), 3),
+            'p50': executions[len(executions) // 2] if len(executions) > 0 else None,
+            'max': executions[-1] if len(executions) > 0 else None,
+        },
+        'sections': ranked(hotspots.sections, total),
+        'nodes': ranked(hotspots.nodes, total)[:args.top],
+        'worst': sorted(results, key=lambda r: -r['execution_ms'])[:args.top],
+    }
+
+def print_report(report):
+    print('{0} tiles, {1} ms executing, p50 {2} ms, max {3} ms'.format(
+        report['tiles'], report['execution_ms']['total'], report['execution_ms']['p50'], report['execution_ms']['max']))
+    row = '{0:<48} {1:>10} {2:>7} {3:>12} {4:>12}'
+    for (title, entries) in [('section', report['sections']), ('node', report['nodes'])]:
+        print()
+        print(row.format(title, 'ms', 'share', 'shared hit', 'shared read'))
+        for e in entries:
+            print(row.format(e['name'][:48], e['ms'], '{0:.1%}'.format(e['share'] or 0), e['Shared Hit Blocks'], e['Shared Read Blocks']))
+    print()
+    print('{0:<24} {1:>10} {2:>9} {3:>12}  {4}'.format('worst tiles', 'ms', 'features', 'shared read', 'dominant'))
+    for r in report['worst']:
+        print('{0:<24} {1:>10} {2:>9} {3:>12}  {4}'.format(r['tile'], r['execution_ms'], r['features'], r['shared_read_blocks'], r['dominant']))
+
+def main():
+    parser = argparse.ArgumentParser(description='EXPLAIN ANALYZE profiler of soundscape_tile over a sample of tiles')
+    parser.add_argument('--dsn', type=str, default='dbname=osm', help='postgres dsn')
+    parser.add_argument('--function', type=str, default='soundscape_tile', help='tile function to profile')
+    parser.add_argument('--where', metavar='region', nargs='+', type=str, help='extracts to sample tiles from')
+    parser.add_argument('--extracts', type=str, default='extracts.json', help='extracts file')
+    parser.add_argument('--tiles', type=str, help='profile the zoom/x/y tiles listed in this file instead of sampling')
+    parser.add_argument('--zoom', type=int, default=16, help='zoom of sampled tiles')
+    parser.add_argument('--sample', type=int, default=100, help='tiles to profile')
+    parser.add_argument('--sample_percent', type=float, default=1.0, help='percent of table blocks features are sampled from')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the sample')
+    parser.add_argument('--warmup', type=int, default=1, help='unexplained runs of each tile first, 0 to see cold buffer reads')
+    parser.add_argument('--statement_timeout', type=int, default=60000, help='milliseconds allowed for each query, 0 for no limit')
+    parser.add_argument('--top', type=int, default=10, help='worst tiles and plan nodes reported')
+    parser.add_argument('--output', type=str, help='also write the report here as JSON')
+
+    args = parser.parse_args()
+
+    if args.tiles == None and args.where == None:
+        parser.error('give --where or --tiles')
+
+    report = profile(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,144 @@ CREATE OR REPLACE FUNCTION
                  ) as building, entrances e
                WHERE building.building_point = e.geometry group by building.osm_id
             ) as elements
-            ORDER BY osm_ids
+            ORDER BY osm_ids, feature_type, feature_value
+$$
+    LANGUAGE SQL
+    STABLE;
+
+--
+-- Database side assembly of a whole tile.  The text produced is byte for
+-- byte what gentiles.py produces with json.dumps(tile, sort_keys=True):
+-- keys in code point order, ', ' and ': ' separators, non-ASCII escaped as
+-- \uXXXX and numbers formatted as Python formats the floats and ints that
+-- psycopg2 decodes from jsonb.
+--
+
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_string (value text)
+   RETURNS text
+   AS $$
+   DECLARE
+     escaped text := to_json(value)::text;
+   BEGIN
+     IF escaped !~ '[^ -~]' THEN
+       RETURN escaped;
+     END IF;
+     RETURN string_agg(
+              CASE
+                WHEN c ~ '[ -~]' THEN c
+                WHEN ascii(c) < 65536 THEN '\u' || lpad(to_hex(ascii(c)), 4, '0')
+                ELSE '\u' || to_hex(55296 + ((ascii(c) - 65536) >> 10)) || '\u' || to_hex(56320 + ((ascii(c) - 65536) & 1023))
+              END, '' ORDER BY n)
+       FROM regexp_split_to_table(escaped, '') WITH ORDINALITY AS chars(c, n);
+   END
+$$
+    LANGUAGE plpgsql
+    IMMUTABLE
+    STRICT;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_number (value text)
+   RETURNS text
+   AS $$
+   DECLARE
+     n numeric;
+     exponent int;
+     digits text;
+   BEGIN
+     -- integers decode to python int and keep their exact digits
+     IF value !~ '[.eE]' THEN
+       RETURN value;
+     END IF;
+     n := value::numeric;
+     IF n = 0 THEN
+       RETURN CASE WHEN left(value, 1) = '-' THEN '-0.0' ELSE '0.0' END;
+     END IF;
+     IF abs(n) >= 1e-4 AND abs(n) < 1e16 THEN
+       digits := rtrim(n::text, '0');
+       IF right(digits, 1) = '.' THEN
+         digits := digits || '0';
+       END IF;
+       RETURN digits;
+     END IF;
+     exponent := floor(log(abs(n)));
+     -- guard against log() landing just either side of a power of ten
+     IF abs(n) / power(10::numeric, exponent) >= 10 THEN
+       exponent := exponent + 1;
+     ELSIF abs(n) / power(10::numeric, exponent) < 1 THEN
+       exponent := exponent - 1;
+     END IF;
+     digits := rtrim(rtrim((n / power(10::numeric, exponent))::text, '0'), '.');
+     RETURN digits || CASE WHEN exponent < 0 THEN 'e-' ELSE 'e+' END || lpad(abs(exponent)::text, 2, '0');
+   END
+$$
+    LANGUAGE plpgsql
+    IMMUTABLE
+    STRICT;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_json (value jsonb)
+   RETURNS text
+   AS $$
+   BEGIN
+     CASE jsonb_typeof(value)
+       WHEN 'object' THEN
+         RETURN '{' || coalesce((SELECT string_agg(soundscape_canonical_string(key) || ': ' || soundscape_canonical_json(member), ', ' ORDER BY key COLLATE "C")
+                                   FROM jsonb_each(value) AS members(key, member)), '') || '}';
+       WHEN 'array' THEN
+         RETURN '[' || coalesce((SELECT string_agg(soundscape_canonical_json(element), ', ' ORDER BY n)
+                                   FROM jsonb_array_elements(value) WITH ORDINALITY AS elements(element, n)), '') || ']';
+       WHEN 'string' THEN
+         RETURN soundscape_canonical_string(value #>> '{}');
+       WHEN 'number' THEN
+         RETURN soundscape_canonical_number(value::text);
+       ELSE
+         RETURN value::text;
+     END CASE;
+   END
+$$
+    LANGUAGE plpgsql
+    IMMUTABLE
+    STRICT;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_tile_json (zoom int, tile_x int, tile_y int)
+   RETURNS text
+   AS $$
+   SELECT '{"features": ['
+          || coalesce(string_agg(soundscape_canonical_json(jsonb_build_object('type', type, 'osm_ids', osm_ids, 'feature_type', feature_type, 'feature_value', feature_value, 'geometry', geometry, 'properties', properties)), ', ' ORDER BY n), '')
+          || '], "type": "FeatureCollection"}'
+     FROM soundscape_tile(zoom, tile_x, tile_y) WITH ORDINALITY AS features(type, osm_ids, feature_type, feature_value, geometry, properties, n)
+$$
+    LANGUAGE SQL
+    STABLE;
+
+--
+-- The same features as a Mapbox Vector Tile, one layer per feature_type.
+-- Geometries are taken from soundscape_tile so both formats always hold
+-- the same features; the 6 decimal GeoJSON is finer than the 4096 unit
+-- grid of a z16 tile.  osm_ids is a comma separated string, as vector
+-- tiles have no arrays, and the keys of properties become attributes.
+-- TileBBox comes from postgis-vt-util.sql.
+--
+
+CREATE OR REPLACE FUNCTION
+   soundscape_tile_mvt (zoom int, tile_x int, tile_y int)
+   RETURNS bytea
+   AS $$
+   WITH features AS (
+     SELECT coalesce(feature_type, 'unknown') as layer, array_to_string(osm_ids, ',') as osm_ids, feature_type, feature_value, properties,
+            ST_AsMVTGeom(ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(geometry::text), 4326), 3857), TileBBox(zoom, tile_x, tile_y, 3857), 4096, 64, true) as geom
+       FROM soundscape_tile(zoom, tile_x, tile_y)
+   )
+   SELECT coalesce(string_agg(mvt, ''::bytea ORDER BY layer), ''::bytea)
+     FROM (
+       SELECT l.layer, (SELECT ST_AsMVT(f, l.layer, 4096, 'geom')
+                          FROM (SELECT osm_ids, feature_type, feature_value, properties, geom
+                                  FROM features
+                                 WHERE features.layer = l.layer AND geom IS NOT NULL) as f) as mvt
+         FROM (SELECT DISTINCT layer FROM features) as l
+     ) as layers
 $$
     LANGUAGE SQL
     STABLE;
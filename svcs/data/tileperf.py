@@ -0,0 +1,446 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+#
+# Load generator for the tile server.  Tile requests either replay the
+# tile paths found in access logs (gentiles.py JSON logs, ingress logs or
+# any text with /zoom/x/y.json in it), or are synthesized by people
+# walking around a city, each fetching the tiles around them that their
+# client does not already hold.  Requests are sent at a fixed rate
+# (--qps, open loop) or by a fixed number of clients (--concurrency,
+# closed loop).  The report, written as JSON so runs can be compared
+# across versions, covers throughput, latency percentiles, error and
+# timeout rates and the cache hit ratios of the server from its /metrics.
+#
+
+import sys
+import math
+import time
+import json
+import random
+import re
+import argparse
+import asyncio
+from collections import OrderedDict, Counter
+from datetime import datetime
+
+import aiohttp
+
+tile_path_re = re.compile(r'/(\d+)/(\d+)/(\d+)\.json')
+
+earth_radius = 6378137.0
+
+def osm_deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (xtile, ytile)
+
+# the point distance metres away from lat, lon along bearing (radians)
+def offset(lat, lon, distance, bearing):
+    dlat = distance * math.cos(bearing) / earth_radius
+    dlon = distance * math.sin(bearing) / (earth_radius * math.cos(math.radians(lat)))
+    return (lat + math.degrees(dlat), lon + math.degrees(dlon))
+
+def tile_path(zoom, x, y):
+    return '/{0}/{1}/{2}.json'.format(zoom, x, y)
+
+#
+# Replay
+#
+
+def replay_paths(paths):
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                match = tile_path_re.search(line)
+                if match != None:
+                    yield tile_path(*match.groups())
+
+#
+# Walk around the city: each walker keeps a heading that drifts, turning
+# sharply now and then as at a street corner, and at each step needs the
+# tiles within --radius of where it is.  Like the app, a walker only
+# fetches tiles it does not hold, and holds its --client_tiles most
+# recent ones.
+#
+
+class Walker(object):
+    def __init__(self, lat, lon, heading, client_tiles):
+        self.lat = lat
+        self.lon = lon
+        self.heading = heading
+        self.client_tiles = client_tiles
+        self.held = OrderedDict()
+
+    def step(self, rng, distance, radius, zoom):
+        if rng.random() < 0.05:
+            self.heading += rng.choice([-1, 1]) * math.pi / 2
+        self.heading += rng.gauss(0, 0.1)
+        (self.lat, self.lon) = offset(self.lat, self.lon, distance, self.heading)
+        (north, _) = offset(self.lat, self.lon, radius, 0)
+        (south, _) = offset(self.lat, self.lon, radius, math.pi)
+        (_, east) = offset(self.lat, self.lon, radius, math.pi / 2)
+        (_, west) = offset(self.lat, self.lon, radius, -math.pi / 2)
+        (x0, y0) = osm_deg2num(north, west, zoom)
+        (x1, y1) = osm_deg2num(south, east, zoom)
+        needed = []
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                if (x, y) in self.held:
+                    self.held.move_to_end((x, y))
+                    continue
+                self.held[(x, y)] = True
+                needed.append(tile_path(zoom, x, y))
+        while len(self.held) > self.client_tiles:
+            self.held.popitem(last=False)
+        return needed
+
+def walk_paths(args):
+    rng = random.Random(args.seed)
+    walkers = []
+    for i in range(args.walkers):
+        (lat, lon) = offset(args.start[0], args.start[1], rng.uniform(0, args.spread), rng.uniform(0, 2 * math.pi))
+        walkers.append(Walker(lat, lon, rng.uniform(0, 2 * math.pi), args.client_tiles))
+    while True:
+        walker = rng.choice(walkers)
+        for path in walker.step(rng, args.speed * args.step, args.radius, args.zoom):
+            yield path
+
+#
+# Server metrics, scraped before and after the run
+#
+
+scraped_counters = [
+    'tile_served_count',
+    'tile_cache_hit_count',
+    'tile_cache_miss_count',
+    'tile_cache_coalesced_count',
+    'tile_store_hit_count',
+    'tile_store_miss_count',
+    'tile_empty_index_hit_count',
+    'tile_shed_queue_count',
+    'tile_shed_deadline_count',
+]
+
+async def scrape(session, url):
+    try:
+        async with session.get(url + '/metrics') as response:
+            if response.status != 200:
+                return None
+            text = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+    values = {}
+    for line in text.splitlines():
+        parts = line.split(' ')
+        if len(parts) == 2 and parts[0] in scraped_counters:
+            values[parts[0]] = float(parts[1])
+    return values
+
+def ratio(part, whole):
+    if whole == 0:
+        return None
+    return round(part / whole, 4)
+
+def cache_report(before, after):
+    if before == None or after == None:
+        return None
+    delta = dict([(name, after.get(name, 0.0) - before.get(name, 0.0)) for name in scraped_counters])
+    lookups = delta['tile_cache_hit_count'] + delta['tile_cache_miss_count'] + delta['tile_cache_coalesced_count']
+    stored = delta['tile_store_hit_count'] + delta['tile_store_miss_count']
+    return {
+        'counters': delta,
+        'cache_hit_ratio': ratio(delta['tile_cache_hit_count'], lookups),
+        'coalesced_ratio': ratio(delta['tile_cache_coalesced_count'], lookups),
+        'store_hit_ratio': ratio(delta['tile_store_hit_count'], stored),
+    }
+
+#
+# Load
+#
+
+class Results(object):
+    def __init__(self):
+        self.latencies = []
+        self.status = Counter()
+        self.timeouts = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def record(self, latency, status, size):
+        self.latencies.append(latency)
+        self.status[str(status)] += 1
+        self.bytes += size
+
+def percentile(ordered, p):
+    if len(ordered) == 0:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)
+    return round(ordered[rank] * 1000, 3)
+
+async def fetch(session, url, path, results, scheduled):
+    try:
+        async with session.get(url + path) as response:
+            body = await response.read()
+            results.record(time.perf_counter() - scheduled, response.status, len(body))
+    except asyncio.TimeoutError:
+        results.timeouts += 1
+    except aiohttp.ClientError:
+        results.failures += 1
+
+def take(paths, args):
+    count = 0
+    end = None
+    if args.duration != None:
+        end = time.perf_counter() + args.duration
+    for path in paths:
+        if args.requests != None and count >= args.requests:
+            return
+        if end != None and time.perf_counter() >= end:
+            return
+        count += 1
+        yield path
+
+async def run_concurrency(session, url, paths, results, concurrency):
+    async def client():
+        for path in paths:
+            await fetch(session, url, path, results, time.perf_counter())
+    await asyncio.gather(*[client() for i in range(concurrency)])
+
+# N.B. latency is measured from when a request was due rather than sent,
+#      so a server falling behind shows in the percentiles
+async def run_qps(session, url, paths, results, qps, max_inflight):
+    start = time.perf_counter()
+    inflight = set()
+    for (i, path) in enumerate(paths):
+        scheduled = start + i / qps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(inflight) >= max_inflight:
+            await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(fetch(session, url, path, results, scheduled))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+    if len(inflight) > 0:
+        await asyncio.wait(inflight)
+
+async def run(args, paths):
+    url = args.url.rstrip('/')
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    results = Results()
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        before = await scrape(session, url) if args.metrics else None
+        started = datetime.utcnow()
+        start = time.perf_counter()
+        if args.qps != None:
+            await run_qps(session, url, take(paths, args), results, args.qps, args.max_inflight)
+        else:
+            await run_concurrency(session, url, take(paths, args), results, args.concurrency)
+        elapsed = time.perf_counter() - start
+        after = await scrape(session, url) if args.metrics else None
+    return report(args, results, started, elapsed, cache_report(before, after))
+
+def report(args, results, started, elapsed, cache):
+    ordered = sorted(results.latencies)
+    sent = len(ordered) + results.timeouts + results.failures
+    errors = sum([n for (status, n) in results.status.items() if status not in ('200', '304')]) + results.failures
+    return {
+        'label': args.label,
+        'url': args.url,
+        'started': started.isoformat() + 'Z',
+        'source': 'replay' if args.replay else 'walk',
+        'mode': 'qps' if args.qps != None else 'concurrency',
+        'target': args.qps if args.qps != None else args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'requests': sent,
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed > 0 else None,
+        'bytes': results.bytes,
+        'status': dict(results.status),
+        'errors': errors,
+        'error_rate': ratio(errors, sent),
+        'timeouts': results.timeouts,
+        'timeout_rate': ratio(results.timeouts, sent),
+        'latency_ms': {
+            'mean': round(sum(ordered) / len(ordered) * 1000, 3) if len(ordered) > 0 else None,
+            'p50': percentile(ordered, 50),
+            'p90': percentile(ordered, 90),
+            'p95': percentile(ordered, 95),
+            'p99': percentile(ordered, 99),
+            'p999': percentile(ordered, 99.9),
+            'max': percentile(ordered, 100),
+        },
+        'server': cache,
+    }
+
+#
+# Format comparison: the first --requests tiles are fetched once in
+# each format (cold, likely generated) and then --rounds times more
+# (warm, from the server cache), plain and gzip, one request at a time.
+# Sizes are the bytes on the wire.
+#
+
+format_suffixes = {'json': '.json', 'mvt': '.mvt'}
+
+async def fetch_format(session, url, path, encoding):
+    start = time.perf_counter()
+    try:
+        async with session.get(url + path, headers={'Accept-Encoding': encoding}) as response:
+            body = await response.read()
+            if response.status != 200:
+                return None
+            return (time.perf_counter() - start, len(body))
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+def median(values):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return None
+    return ordered[len(ordered) // 2]
+
+async def run_formats(args, paths):
+    url = args.url.rstrip('/')
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    tiles = [path[:-len('.json')] for path in take(paths, args)]
+    formats = OrderedDict()
+    async with aiohttp.ClientSession(timeout=timeout, auto_decompress=False) as session:
+        for name in args.formats:
+            stats = {'cold': [], 'warm': [], 'identity': [], 'gzip': [], 'failed': 0}
+            for tile in tiles:
+                path = tile + format_suffixes[name]
+                cold = await fetch_format(session, url, path, 'identity')
+                if cold == None:
+                    stats['failed'] += 1
+                    continue
+                stats['cold'].append(cold[0])
+                stats['identity'].append(cold[1])
+                for i in range(args.rounds):
+                    for encoding in ['identity', 'gzip']:
+                        warm = await fetch_format(session, url, path, encoding)
+                        if warm != None:
+                            stats['warm'].append(warm[0])
+                            if i == 0 and encoding == 'gzip':
+                                stats['gzip'].append(warm[1])
+            cold = sorted(stats['cold'])
+            warm = sorted(stats['warm'])
+            formats[name] = {
+                'tiles': len(cold),
+                'failed': stats['failed'],
+                'bytes': sum(stats['identity']),
+                'gzip_bytes': sum(stats['gzip']),
+                'median_bytes': median(stats['identity']),
+                'median_gzip_bytes': median(stats['gzip']),
+                'cold_ms': {'p50': percentile(cold, 50), 'p90': percentile(cold, 90), 'max': percentile(cold, 100)},
+                'warm_ms': {'p50': percentile(warm, 50), 'p90': percentile(warm, 90), 'max': percentile(warm, 100)},
+            }
+    return {
+        'label': args.label,
+        'url': args.url,
+        'source': 'replay' if args.replay else 'walk',
+        'formats': formats,
+    }
+
+def format_table(result):
+    names = list(result['formats'].keys())
+    lines = ['{0:<18}'.format('') + ''.join(['{0:>12}'.format(n) for n in names])]
+    for (title, keys) in [('tiles', ['tiles']), ('bytes', ['bytes']), ('gzip_bytes', ['gzip_bytes']),
+                          ('median_bytes', ['median_bytes']), ('median_gzip', ['median_gzip_bytes']),
+                          ('cold_p50_ms', ['cold_ms', 'p50']), ('cold_p90_ms', ['cold_ms', 'p90']),
+                          ('warm_p50_ms', ['warm_ms', 'p50']), ('warm_p90_ms', ['warm_ms', 'p90'])]:
+        lines.append('{0:<18}'.format(title) + ''.join(['{0:>12}'.format(str(lookup(result['formats'][n], keys))) for n in names]))
+    return '\n'.join(lines)
+
+#
+# Comparison against an earlier report
+#
+
+compared = [
+    ('throughput_rps', ['throughput_rps']),
+    ('error_rate', ['error_rate']),
+    ('timeout_rate', ['timeout_rate']),
+    ('p50_ms', ['latency_ms', 'p50']),
+    ('p90_ms', ['latency_ms', 'p90']),
+    ('p99_ms', ['latency_ms', 'p99']),
+    ('p999_ms', ['latency_ms', 'p999']),
+    ('cache_hit_ratio', ['server', 'cache_hit_ratio']),
+]
+
+def lookup(result, keys):
+    for key in keys:
+        if result == None:
+            return None
+        result = result.get(key)
+    return result
+
+def compare(baseline, result):
+    lines = ['{0:<16} {1:>12} {2:>12} {3:>9}'.format('', baseline['label'] or 'baseline', result['label'] or 'this run', 'change')]
+    for (name, keys) in compared:
+        a = lookup(baseline, keys)
+        b = lookup(result, keys)
+        change = ''
+        if a != None and b != None and a != 0:
+            change = '{0:+.1f}%'.format((b - a) / a * 100)
+        lines.append('{0:<16} {1:>12} {2:>12} {3:>9}'.format(name, str(a), str(b), change))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='load generator for the Soundscape tile server')
+    parser.add_argument('url', type=str, help='tile server URL, e.g. http://localhost:8080 or https://host/tiles')
+    parser.add_argument('--replay', type=str, nargs='+', help='access logs to replay, in order')
+    parser.add_argument('--walkers', type=int, default=50, help='people walking when synthesizing requests')
+    parser.add_argument('--start', type=float, nargs=2, metavar=('LAT', 'LON'), default=[47.6062, -122.3321], help='centre of the walk')
+    parser.add_argument('--spread', type=float, default=2000.0, help='metres from --start walkers set out from')
+    parser.add_argument('--speed', type=float, default=1.4, help='walking speed in metres per second')
+    parser.add_argument('--step', type=float, default=5.0, help='seconds between position updates')
+    parser.add_argument('--radius', type=float, default=300.0, help='metres around a walker it needs tiles for')
+    parser.add_argument('--client_tiles', type=int, default=64, help='tiles held by the client of a walker')
+    parser.add_argument('--zoom', type=int, default=16, help='zoom of synthesized requests')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the walk')
+    parser.add_argument('--qps', type=float, help='send requests at this rate (open loop)')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients sending requests back to back (closed loop)')
+    parser.add_argument('--max_inflight', type=int, default=1000, help='most requests outstanding with --qps')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request counts as timed out')
+    parser.add_argument('--no_metrics', dest='metrics', action='store_false', help='do not scrape /metrics for cache hit ratios')
+    parser.add_argument('--label', type=str, help='name of this run in the report, e.g. the server version')
+    parser.add_argument('--output', type=str, help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', type=str, help='earlier JSON report to compare this run with')
+    parser.add_argument('--formats', type=str, nargs='+', choices=list(format_suffixes.keys()), help='compare tile size and latency of these formats instead of putting load on the server')
+    parser.add_argument('--rounds', type=int, default=3, help='warm fetches of each tile with --formats')
+
+    args = parser.parse_args()
+
+    if args.replay == None and args.requests == None and args.duration == None:
+        parser.error('a walk needs --requests or --duration')
+    if args.formats and args.compare:
+        parser.error('--compare compares load reports, not --formats')
+
+    if args.replay:
+        paths = replay_paths(args.replay)
+    else:
+        paths = walk_paths(args)
+
+    loop = asyncio.get_event_loop()
+    if args.formats:
+        result = loop.run_until_complete(run_formats(args, paths))
+        print(format_table(result), file=sys.stderr)
+    else:
+        result = loop.run_until_complete(run(args, paths))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(json.load(f), result), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()